@@ -0,0 +1,142 @@
+# Small script to collect API keys, access policies and inactive identities
+# for all accounts an API key has access to. The accounts are processed in
+# parallel, each with its own account-scoped token, while all of them share
+# one budget of requests in flight. The data is exported per account and
+# merged into one table per dataset with the account ID as first column.
+
+# only the requests package is used, no other installation necessary
+import json, sys,os, tempfile
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from IAMclient import POOL_SIZE, fetchOrdered, setMaxPerHost, setRequestBudget
+from IAMtoken import TokenManager
+from IAMindex import buildIdentityIndex
+from IAMoutput import APIKEYS, INACTIVE_IDENTITIES, POLICIES, TableWriter
+from IAMkeys import apiKeyRecord, getAccounts, getApiKeyDetails, iterApiKeyPages
+from IAMpolicies import iterPoliciesV2, policyRecord
+from IAMia import getReport, identityRecord, reportEntries
+from IAMprofile import profiler
+
+
+SCHEMAS={'apikeys': APIKEYS, 'policies': POLICIES, 'inactive_identities': INACTIVE_IDENTITIES}
+
+# read an API key from a JSON file
+def readApiKey(filename):
+    with open(filename) as data_file:
+        credentials = json.load(data_file)
+    api_key = credentials.get('apikey')
+    return api_key
+
+# write the records of an account to its own table and to a spool file, one
+# JSON object per line. Only once all datasets of the account are complete,
+# the spooled records are added to the merged table shared by all accounts,
+# so a failed account leaves no partial rows in the merged tables.
+class AccountWriter:
+    def __init__(self, writer, spool):
+        self.writer=writer
+        self.spool=spool
+
+    def write(self, record):
+        self.writer.write(record)
+        self.spool.write(json.dumps(record)+'\n')
+
+    # add the spooled records with the account ID to the merged table
+    def merge(self, merged, account_id):
+        self.spool.seek(0)
+        for line in self.spool:
+            merged.write(dict(json.loads(line), account_id=account_id))
+
+# the API keys of users and service IDs with their details, the export has no history
+def collectApiKeys(iam_token, account_id, users, writer, workers=1):
+    for id_type in ['user','serviceid']:
+        for apikeys, next_token in iterApiKeyPages(iam_token, account_id, None, id_type):
+            for apikey, apikey_details in fetchOrdered(lambda apikey: getApiKeyDetails(iam_token, apikey['id'], history=False), apikeys, workers):
+                writer.write(apiKeyRecord(apikey_details, users))
+
+def collectPolicies(iam_token, account_id, users, writer):
+    for policy in iterPoliciesV2(iam_token, account_id):
+        writer.write(policyRecord(policy, users))
+
+# the entries of an existing inactive identities report, streamed
+def collectInactiveIdentities(iam_token, account_id, report_id, writer):
+    report=getReport(iam_token, account_id, report_id, stream=True)
+    if report is None:
+        print("{}: the report {} is not available yet".format(account_id, report_id), file=sys.stderr)
+        return
+    for section, item in reportEntries(report):
+        writer.write(identityRecord(section, item, None))
+
+# collect the datasets of one account concurrently into the directory of the
+# account and the merged tables
+def collectAccount(api_key, account_id, datasets, output_dir, merged, workers=1, report_id='latest', emails=False):
+    iam_token=TokenManager(api_key, account_id)
+    directory=os.path.join(output_dir, account_id)
+    os.makedirs(directory, exist_ok=True)
+    users=buildIdentityIndex(iam_token, account_id) if emails else None
+    collectors={'apikeys': lambda writer: collectApiKeys(iam_token, account_id, users, writer, workers),
+                'policies': lambda writer: collectPolicies(iam_token, account_id, users, writer),
+                'inactive_identities': lambda writer: collectInactiveIdentities(iam_token, account_id, report_id, writer)}
+    with ExitStack() as stack:
+        writers={}
+        with ThreadPoolExecutor(max_workers=len(datasets)) as executor:
+            futures=[]
+            for dataset in datasets:
+                writer=stack.enter_context(TableWriter(os.path.join(directory, dataset), SCHEMAS[dataset]))
+                writers[dataset]=AccountWriter(writer, stack.enter_context(tempfile.TemporaryFile('w+')))
+                futures.append(executor.submit(collectors[dataset], writers[dataset]))
+            for future in futures:
+                future.result()
+        for dataset, writer in writers.items():
+            writer.merge(merged[dataset], account_id)
+
+# collect the datasets for all accounts, up to "parallel" accounts at a time.
+# A failing account is reported and doesn't stop the others, its records are
+# not merged. The number of failed accounts is returned.
+def collectAccounts(api_key, account_ids, datasets, output_dir, parallel=4, workers=1, report_id='latest', emails=False):
+    failed=0
+    os.makedirs(output_dir, exist_ok=True)
+    with ExitStack() as stack, ThreadPoolExecutor(max_workers=parallel) as executor:
+        merged={dataset: stack.enter_context(TableWriter(os.path.join(output_dir, dataset), SCHEMAS[dataset].withAccount()))
+                for dataset in datasets}
+        futures={executor.submit(collectAccount, api_key, account_id, datasets, output_dir, merged, workers, report_id, emails): account_id
+                 for account_id in account_ids}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                print("{}: done".format(futures[future]), file=sys.stderr)
+            except (Exception, SystemExit) as e:
+                failed+=1
+                print("{}: failed, {}".format(futures[future], e), file=sys.stderr)
+    return failed
+
+if __name__== "__main__":
+    # define the command line arguments
+    parser = argparse.ArgumentParser(description='Collect API keys, policies and inactive identities for several IBM Cloud accounts in parallel')
+    parser.add_argument('--credentials', type=str, action='store', dest='credfile', required=True, help='credential file to use')
+    parser.add_argument('--accounts', type=str, dest='accounts', nargs='*', help='IDs of the accounts to process, default all accessible accounts')
+    parser.add_argument('--datasets', choices=list(SCHEMAS), dest='datasets', default=list(SCHEMAS), nargs='*', help='datasets to collect')
+    parser.add_argument('--output-dir', type=str, dest='output_dir', default='accounts', help='directory for the tables, one subdirectory per account')
+    parser.add_argument('--parallel', type=int, dest='parallel', default=4, help='number of accounts processed in parallel')
+    parser.add_argument('--workers', type=int, dest='workers', default=4, help='number of API key details to retrieve in parallel per account')
+    parser.add_argument('--budget', type=int, dest='budget', default=16, help='number of requests in flight across all accounts')
+    parser.add_argument('--reportid', type=str, action='store', dest='reportid', default='latest', help='the inactive identities report to collect')
+    parser.add_argument('--emails', action='store_true', dest='emails', help='add the email addresses of creators and subjects, requires the privilege to list users')
+    parser.add_argument('--profile', nargs='?', const='', dest='profile', metavar='TRACE_FILE', help='print a profile of the requests per endpoint at the end, optionally write a timeline in Chrome trace format to TRACE_FILE')
+    # parse the parameters
+    args = parser.parse_args()
+    if args.profile is not None:
+        profiler.enable(args.profile or None)
+
+    # all accounts share one budget, the connection pool bounds the requests per host
+    setRequestBudget(args.budget)
+    setMaxPerHost(min(args.budget, POOL_SIZE))
+
+    apiKey=readApiKey(args.credfile)
+    account_ids=args.accounts
+    if not account_ids:
+        account_ids=[account['metadata']['guid'] for account in getAccounts(TokenManager(apiKey))['resources']]
+    print("Processing {} accounts".format(len(account_ids)), file=sys.stderr)
+    failed=collectAccounts(apiKey, account_ids, args.datasets, args.output_dir, args.parallel, args.workers, args.reportid, args.emails)
+    if failed:
+        sys.exit("{} of {} accounts failed".format(failed, len(account_ids)))
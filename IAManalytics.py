@@ -0,0 +1,201 @@
+# Small script to analyze the inactivity of API keys, identities and access
+# policies in the local inventory (see IAMinventory.py, run "sync" first).
+# The records are loaded into columns once, with the timestamps converted to
+# epoch seconds by SQLite, and the histograms, top creators and threshold
+# filters are computed on whole columns instead of record by record.
+# NumPy is used if installed, else the columns are arrays of the array module.
+
+import sys, csv, time
+import argparse
+from array import array
+from bisect import bisect_right
+from heapq import nlargest
+from IAMoutput import JSONWriter
+from IAMinventory import INACTIVITY_BUCKETS, openInventory
+
+# NumPy is optional, without it the same operations run on array columns
+try:
+    import numpy
+except ImportError:
+    numpy=None
+
+
+# days for identities which never authenticated and keys not in the
+# activity report, i.e. active within the duration of the report
+NEVER=-1
+NOT_REPORTED=-2
+SECONDS_PER_DAY=86400
+# the labels of the bucket codes, see bucketCodes
+BUCKETS=(['not_reported','never']+['{}-{}d'.format(lower, upper) for lower, upper in zip([0]+INACTIVITY_BUCKETS, INACTIVITY_BUCKETS)]
+         +['{}d+'.format(INACTIVITY_BUCKETS[-1])])
+
+# the timestamp column as epoch seconds, NEVER if missing
+def epoch(column):
+    return "coalesce(CAST(strftime('%s', {}) AS INTEGER), {})".format(column, NEVER)
+
+# the datasets to analyze, the tables and the expression of each column.
+# "days" is the epoch of the last authentication (permit for policies),
+# converted to days since then when loaded. Keys are joined with the activity
+# report for it.
+DATASETS={
+    'apikeys': ("""apikeys k LEFT JOIN activity a ON a.account_id=k.account_id AND a.section='apikeys' AND a.id=k.id""",
+                {'account_id': 'k.account_id', 'id': 'k.id', 'name': 'k.name', 'group': 'k.type', 'creator': 'k.created_by',
+                 'days': 'CASE WHEN a.id IS NULL THEN {} ELSE {} END'.format(NOT_REPORTED, epoch('a.last_authn'))}),
+    'identities': ('activity',
+                   {'account_id': 'account_id', 'id': 'id', 'name': 'name', 'group': 'section', 'creator': 'NULL',
+                    'days': epoch('last_authn')}),
+    'policies': ('policies',
+                 {'account_id': 'account_id', 'id': 'id', 'name': 'description', 'group': 'type', 'creator': 'created_by_id',
+                  'days': epoch('last_permit_at')}),
+}
+# the columns each report needs, only those are loaded
+REPORT_COLUMNS={'inactivity': ['group','days'], 'creators': ['creator','days'],
+                'stale': ['account_id','id','name','group','creator','days']}
+
+# a column of integers, as NumPy array or array('q')
+def intColumn(values):
+    if numpy is not None:
+        return numpy.fromiter(values, dtype=numpy.int64)
+    return array('q', values)
+
+# load the named columns of a dataset of the inventory as dictionary of columns.
+# Timestamps are converted to the days since then, relative to "now" (epoch
+# seconds), timestamps in the future count as today.
+def loadDataset(db, dataset, names, account_id=None, now=None):
+    now=int(time.time()) if now is None else now
+    tables, expressions=DATASETS[dataset]
+    rows=db.execute('SELECT {} FROM {} WHERE ? IS NULL OR {}=?'.format(
+                    ','.join(expressions[name] for name in names), tables, expressions['account_id']), (account_id, account_id)).fetchall()
+    columns=dict(zip(names, zip(*rows))) if rows else {name: () for name in names}
+    epochs=intColumn(columns['days'])
+    if numpy is not None:
+        columns['days']=numpy.where(epochs<0, epochs, numpy.maximum(0, (now-epochs)//SECONDS_PER_DAY))
+    else:
+        columns['days']=array('q', (value if value<0 else max(0, (now-value)//SECONDS_PER_DAY) for value in epochs))
+    return columns
+
+# encode the values of a column as integer codes, returns the codes and the
+# values in the order of their codes
+def encodeColumn(values):
+    index={}
+    codes=intColumn(index.setdefault(value, len(index)) for value in values)
+    return codes, list(index)
+
+# the bucket code of each value of a days column, an index into BUCKETS
+def bucketCodes(days):
+    if numpy is not None:
+        return numpy.where(days<0, days+2, numpy.searchsorted(INACTIVITY_BUCKETS, days, side='right')+2)
+    return array('q', (value+2 if value<0 else bisect_right(INACTIVITY_BUCKETS, value)+2 for value in days))
+
+# count the occurrences of each code in 0..size-1, only at the selected positions if given
+def countCodes(codes, size, selected=None):
+    if numpy is not None:
+        return numpy.bincount(codes if selected is None else codes[selected], minlength=size)
+    counts=[0]*size
+    for code in (codes if selected is None else (codes[position] for position in selected)):
+        counts[code]+=1
+    return counts
+
+# the positions of the records not active in the given number of days, never
+# active included, those not in the activity report are active
+def selectStale(days, threshold):
+    if numpy is not None:
+        return numpy.flatnonzero((days==NEVER)|(days>=threshold))
+    return [position for position, value in enumerate(days) if value==NEVER or value>=threshold]
+
+# the positions ordered by the days since the last activity, never first
+def orderByDays(days, positions):
+    if numpy is not None:
+        keys=numpy.where(days[positions]==NEVER, numpy.iinfo(numpy.int64).max, days[positions])
+        return positions[numpy.argsort(-keys, kind='stable')]
+    return sorted(positions, key=lambda position: -days[position] if days[position]!=NEVER else -sys.maxsize)
+
+# histogram of the days since the last activity per group, e.g. key type.
+# Yields records with group, bucket and count.
+def inactivityHistogram(columns, dataset):
+    groups, labels=encodeColumn(columns['group'])
+    buckets=bucketCodes(columns['days'])
+    # one code per combination of group and bucket
+    if numpy is not None:
+        combined=groups*len(BUCKETS)+buckets
+    else:
+        combined=array('q', (group*len(BUCKETS)+bucket for group, bucket in zip(groups, buckets)))
+    counts=countCodes(combined, len(labels)*len(BUCKETS))
+    for group_code, group in enumerate(labels):
+        for bucket_code, bucket in enumerate(BUCKETS):
+            count=int(counts[group_code*len(BUCKETS)+bucket_code])
+            if count:
+                yield {"dataset": dataset, "group": group, "bucket": bucket, "count": count}
+
+# the creators with the most records not active in "threshold" days. Yields
+# records with the creator, the number of stale and of all their records.
+def staleCreators(columns, threshold, top=10):
+    creators, labels=encodeColumn(columns['creator'])
+    stale=countCodes(creators, len(labels), selectStale(columns['days'], threshold))
+    totals=countCodes(creators, len(labels))
+    if numpy is not None:
+        ranking=numpy.argsort(-stale, kind='stable')[:top]
+    else:
+        ranking=nlargest(top, range(len(labels)), key=stale.__getitem__)
+    for code in ranking:
+        if stale[code]:
+            yield {"creator": labels[code], "stale": int(stale[code]), "total": int(totals[code])}
+
+# the records not active in "threshold" days, longest inactive first
+def staleRecords(columns, threshold):
+    days=columns['days']
+    for position in orderByDays(days, selectStale(days, threshold)):
+        yield {"account_id": columns['account_id'][position], "id": columns['id'][position], "name": columns['name'][position],
+               "group": columns['group'][position], "creator": columns['creator'][position],
+               "days": int(days[position]) if days[position]!=NEVER else None}
+
+# print the records as CSV (with header) or JSON
+def printRecords(records, out_format, columns):
+    if out_format=='CSV':
+        out=csv.writer(sys.stdout)
+        out.writerow(columns)
+        out.writerows([record[column] for column in columns] for record in records)
+    else:
+        with JSONWriter(ndjson=out_format=='NDJSON') as writer:
+            for record in records:
+                writer.write(record)
+
+if __name__== "__main__":
+    # define the command line arguments
+    parser = argparse.ArgumentParser(description='Analyze the inactivity of API keys, identities and policies in the local inventory')
+    parser.add_argument('--report', choices=['inactivity','creators','stale'], dest='report', default='inactivity',
+                        help='histogram of the days since the last activity (inactivity), creators with the most stale records (creators) or the stale records (stale)')
+    parser.add_argument('--dataset', choices=list(DATASETS), dest='datasets', default=None, nargs='+',
+                        help='datasets to analyze, default all for inactivity and apikeys otherwise')
+    parser.add_argument('--days', type=int, dest='days', default=90, help='records not active (authenticated or permitted) in this many days are stale')
+    parser.add_argument('--top', type=int, dest='top', default=10, help='number of creators to list')
+    parser.add_argument('--account', type=str, dest='account_id', help='only analyze this account of the inventory')
+    parser.add_argument('--output', choices=['CSV','JSON','NDJSON'], dest='out_format', default='CSV',
+                        help='return output in CSV, JSON or newline-delimited JSON format')
+    # parse the parameters
+    args = parser.parse_args()
+    datasets=args.datasets or (list(DATASETS) if args.report=='inactivity' else ['apikeys'])
+    if args.report=='creators' and 'identities' in datasets:
+        parser.error('--report creators supports the datasets apikeys and policies')
+
+    start=time.perf_counter()
+    db=openInventory()
+    try:
+        loaded={dataset: loadDataset(db, dataset, REPORT_COLUMNS[args.report], args.account_id) for dataset in datasets}
+    finally:
+        db.close()
+    loaded_at=time.perf_counter()
+
+    if args.report=='inactivity':
+        records=[record for dataset in datasets for record in inactivityHistogram(loaded[dataset], dataset)]
+        columns=['dataset','group','bucket','count']
+    elif args.report=='creators':
+        records=[dict(record, dataset=dataset) for dataset in datasets for record in staleCreators(loaded[dataset], args.days, args.top)]
+        columns=['dataset','creator','stale','total']
+    else:
+        records=[dict(record, dataset=dataset) for dataset in datasets for record in staleRecords(loaded[dataset], args.days)]
+        columns=['dataset','account_id','id','name','group','creator','days']
+    print("Loaded {} records in {:.0f} ms, analyzed in {:.0f} ms{}".format(
+          sum(len(dataset['days']) for dataset in loaded.values()), (loaded_at-start)*1000,
+          (time.perf_counter()-loaded_at)*1000, '' if numpy is not None else ' (without NumPy)'), file=sys.stderr)
+    printRecords(records, args.out_format, columns)
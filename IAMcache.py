@@ -0,0 +1,197 @@
+# Local cache for the details of API keys and trusted profiles, stored in
+# SQLite under the cache directory. The details include the activity
+# (last_authn, authn_count), which changes with every authentication, so an
+# entry is only reused for a short time to live (TTL). The activity can't be
+# retrieved on its own, an expired entry is retrieved again as a whole.
+# The same database helpers keep snapshots of previous runs for the delta mode,
+# and a journal allows to resume an interrupted run.
+
+import json, os, sqlite3, sys, threading, time
+from IAMclient import apiRequest, decodeJSON
+
+
+# seconds until cached details need to be retrieved again, a longer time saves
+# more requests but reports an older activity
+CACHE_TTL=float(os.getenv('IAM_CACHE_TTL', 3600))
+# maximum number of cached entries, the least recently used are removed
+MAX_ENTRIES=200000
+# writes are committed in batches
+COMMIT_EVERY=100
+
+# the directory for cache files, IAM_CACHE_DIR overrides the default
+def cacheDir():
+    default=os.path.join(os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'ibmcloud-iam')
+    return os.getenv('IAM_CACHE_DIR', default)
+
+# open a SQLite database in the cache directory, readable only by the user
+def openDatabase(filename):
+    directory=cacheDir()
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    path=os.path.join(directory, filename)
+    connection=sqlite3.connect(path, check_same_thread=False)
+    os.chmod(path, 0o600)
+    return connection
+
+class DetailsCache:
+    def __init__(self, ttl=None, max_entries=MAX_ENTRIES):
+        self.ttl=ttl if ttl is not None else CACHE_TTL
+        self.max_entries=max_entries
+        self.lock=threading.Lock()
+        self.pending=0
+        self.db=openDatabase('details.sqlite')
+        # earlier versions stored metadata and activity apart in "details"
+        self.db.execute('DROP TABLE IF EXISTS details')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS cached_details (
+                             kind TEXT, id TEXT, details TEXT, retrieved_at REAL, used_at REAL,
+                             PRIMARY KEY (kind, id))''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS cached_details_used ON cached_details (used_at)')
+        self.db.commit()
+
+    def lookup(self, kind, item_id):
+        with self.lock:
+            return self.db.execute('SELECT details, retrieved_at FROM cached_details WHERE kind=? AND id=?',
+                                   (kind, item_id)).fetchone()
+
+    def write(self, statement, values):
+        with self.lock:
+            self.db.execute(statement, values)
+            self.pending+=1
+            if self.pending>=COMMIT_EVERY:
+                self.db.commit()
+                self.pending=0
+
+    # return the details of an API key or trusted profile. "kind" separates
+    # entries retrieved with different parameters, e.g. with or without history.
+    # Fresh entries are served from the cache, else the URL is requested.
+    def getDetails(self, kind, item_id, url, iam_token, params=None):
+        now=time.time()
+        row=self.lookup(kind, item_id)
+        if row is not None and now-row[1]<self.ttl:
+            self.write('UPDATE cached_details SET used_at=? WHERE kind=? AND id=?', (now, kind, item_id))
+            return json.loads(row[0])
+        details=decodeJSON(apiRequest('GET', url, iam_token, params=params))
+        self.write('INSERT OR REPLACE INTO cached_details VALUES (?,?,?,?,?)',
+                   (kind, item_id, json.dumps(details), now, now))
+        return details
+
+    # remove the least recently used entries above the size limit
+    def prune(self):
+        with self.lock:
+            count=self.db.execute('SELECT COUNT(*) FROM cached_details').fetchone()[0]
+            if count>self.max_entries:
+                self.db.execute('DELETE FROM cached_details WHERE rowid IN (SELECT rowid FROM cached_details ORDER BY used_at LIMIT ?)',
+                                (count-self.max_entries,))
+
+    def close(self):
+        self.prune()
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+# state of the previous run, used to report only what changed since then.
+# For each item, a fingerprint of its list-level fields and the record last
+# reported for it are stored. The new state replaces the previous one only
+# when save() is called at the end of a complete run.
+class Snapshot:
+    def __init__(self, name):
+        self.name=name
+        self.lock=threading.Lock()
+        self.db=openDatabase('snapshots.sqlite')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS snapshots (
+                             name TEXT, id TEXT, fingerprint TEXT, record TEXT,
+                             PRIMARY KEY (name, id))''')
+        self.previous={row[0]: (row[1], row[2]) for row in
+                       self.db.execute('SELECT id, fingerprint, record FROM snapshots WHERE name=?', (name,))}
+        self.current={}
+
+    # compare an item to the previous run, return "added", "changed" or None
+    # if it is unchanged. The record is kept unless replaced by update().
+    def check(self, item_id, fingerprint, record=None):
+        fingerprint=json.dumps(fingerprint)
+        with self.lock:
+            old=self.previous.get(item_id)
+            if old is not None and old[0]==fingerprint:
+                self.current[item_id]=old
+                return None
+            self.current[item_id]=(fingerprint, json.dumps(record))
+        return 'added' if old is None else 'changed'
+
+    # replace the stored record for an item, e.g., with the retrieved details
+    def update(self, item_id, record):
+        with self.lock:
+            self.current[item_id]=(self.current[item_id][0], json.dumps(record))
+
+    # yield (id, record) for the items of the previous run not seen in this run
+    def removed(self):
+        for item_id, (fingerprint, record) in self.previous.items():
+            if item_id not in self.current:
+                yield item_id, json.loads(record)
+
+    def save(self):
+        with self.db:
+            self.db.execute('DELETE FROM snapshots WHERE name=?', (self.name,))
+            self.db.executemany('INSERT INTO snapshots VALUES (?,?,?,?)',
+                                ((self.name, item_id, fingerprint, record) for item_id, (fingerprint, record) in self.current.items()))
+
+    def close(self):
+        self.db.close()
+
+# journal of a long run to resume it after an interruption. It records the
+# page token up to which a listing is completed and the IDs of the items
+# already reported. The journal is a file with one JSON object per line in the
+# cache directory, removed by finish() after a complete run.
+class Journal:
+    def __init__(self, name, resume=False):
+        os.makedirs(cacheDir(), mode=0o700, exist_ok=True)
+        self.path=os.path.join(cacheDir(), 'journal-'+name.replace('/', '_')+'.jsonl')
+        self.lock=threading.Lock()
+        self.done=set()
+        self.cursors={}
+        if resume and os.path.exists(self.path):
+            with open(self.path) as journal_file:
+                for line in journal_file:
+                    try:
+                        entry=json.loads(line)
+                    except ValueError:
+                        # the last line might be incomplete
+                        continue
+                    if 'done' in entry:
+                        self.done.add(entry['done'])
+                    else:
+                        self.cursors[entry['listing']]=entry['cursor']
+        # a resumed run continues output that was started before
+        self.resumed=bool(self.done or self.cursors)
+        self.file=open(self.path, 'a' if resume else 'w')
+        os.chmod(self.path, 0o600)
+
+    # the output is flushed first, so what the journal records as reported
+    # is in the output file even if the run is killed right after
+    def write(self, entry):
+        sys.stdout.flush()
+        with self.lock:
+            self.file.write(json.dumps(entry)+'\n')
+            self.file.flush()
+
+    def isDone(self, item_id):
+        return item_id in self.done
+
+    def markDone(self, item_id):
+        self.done.add(item_id)
+        self.write({"done": item_id})
+
+    # the page token to continue a listing with, None to start from the
+    # beginning and "done" if the listing is complete
+    def cursor(self, listing):
+        return self.cursors.get(listing)
+
+    def setCursor(self, listing, cursor):
+        self.cursors[listing]=cursor
+        self.write({"listing": listing, "cursor": cursor})
+
+    def close(self):
+        self.file.close()
+
+    # the run is complete, nothing to resume
+    def finish(self):
+        self.close()
+        os.remove(self.path)
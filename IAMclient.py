@@ -0,0 +1,474 @@
+# Shared helpers for the IAM scripts (IAMkeys.py, IAMia.py, IAMpolicies.py).
+# All API calls go through one keep-alive session, so the TCP and TLS handshake
+# is done once per host and not for every page or key detail. Errors are
+# handled in one place.
+# Retrieving details for thousands of API keys or trusted profiles one at a
+# time is dominated by waiting on the network. The functions below run such
+# independent requests with bounded concurrency while keeping the output in
+# the original order. Paginated listings are streamed page by page, large
+# JSON documents can be parsed while they are received.
+# Rate limits (429) and transient errors (5xx) don't end a run. Requests are
+# paced per endpoint, retried with backoff and the number of parallel requests
+# per host adapts to the throttling observed (AIMD).
+# With profiling enabled (IAMprofile), every attempt is recorded per endpoint.
+
+import requests, codecs, json, os, queue, random, sys, threading, time, atexit
+from collections import Counter, deque
+from contextlib import nullcontext
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from IAMprofile import endpointName, profiler
+
+
+# default number of requests in flight against a single host
+MAX_PER_HOST=8
+# connections kept open per host, should not be below MAX_PER_HOST
+POOL_SIZE=16
+# connect and read timeout in seconds, can be overwritten by the
+# environment variables IAM_CONNECT_TIMEOUT and IAM_READ_TIMEOUT
+TIMEOUT=(float(os.getenv('IAM_CONNECT_TIMEOUT', 10)), float(os.getenv('IAM_READ_TIMEOUT', 120)))
+# send all requests to another endpoint instead, e.g. to the local mock
+# server used by the benchmarks, set by the environment variable IAM_API_ENDPOINT
+API_ENDPOINT=os.getenv('IAM_API_ENDPOINT')
+# requests per second (and burst size) per endpoint, IAM_RATE_LIMIT overrides
+# it, 0 for no pacing. Endpoints are paused after throttling either way.
+RATE_LIMIT=float(os.getenv('IAM_RATE_LIMIT', 50))
+# retries for rate limited (429) or failed (5xx) requests and connection errors.
+# Other methods than GET are only retried on 429 and if the connection couldn't
+# be established in time, as they might have been processed already otherwise.
+MAX_RETRIES=int(os.getenv('IAM_MAX_RETRIES', 6))
+RETRY_STATUS={429, 500, 502, 503, 504}
+# bytes read at a time from streamed responses
+CHUNK_SIZE=64*1024
+# exponential backoff in seconds, starting value and upper bound
+BACKOFF_BASE=0.5
+BACKOFF_MAX=60
+
+host_limits={}
+host_limits_lock=threading.Lock()
+buckets={}
+buckets_lock=threading.Lock()
+# optional limit of requests in flight across all hosts and pipeline stages
+request_budget=nullcontext()
+# counters for the summary at the end of the run
+stats=Counter()
+stats_lock=threading.Lock()
+
+# count an event for the summary
+def countStat(name, value=1):
+    with stats_lock:
+        stats[name]+=value
+
+# print retries, throttling and backoff to stderr if there were any
+def printStats():
+    if stats['retries'] or stats['throttled']:
+        print("IAM requests: {}, retries: {}, throttled (429): {}, backoff: {:.1f}s".format(
+              stats['requests'], stats['retries'], stats['throttled'], stats['backoff_seconds']), file=sys.stderr)
+
+atexit.register(printStats)
+
+# token bucket to pace the requests against an endpoint, a rate of 0 means
+# no pacing. After throttling, the endpoint can be paused for all requests.
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate=rate
+        self.burst=burst
+        self.tokens=burst
+        self.updated=time.monotonic()
+        self.paused_until=0
+        self.lock=threading.Lock()
+
+    # take a token, wait if none is available or the endpoint is paused
+    def take(self):
+        with self.lock:
+            now=time.monotonic()
+            wait=max(0, self.paused_until-now)
+            if self.rate>0:
+                self.tokens=min(self.burst, self.tokens+(now-self.updated)*self.rate)
+                self.updated=now
+                self.tokens-=1
+                if self.tokens<0:
+                    wait=max(wait, -self.tokens/self.rate)
+        if wait>0:
+            time.sleep(wait)
+
+    # no requests for the given number of seconds, e.g. after Retry-After
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until=max(self.paused_until, time.monotonic()+seconds)
+
+# limit of parallel requests against a host, used as context manager around a
+# request. The limit grows by one per window of successful requests and is
+# halved when the host throttles (additive increase, multiplicative decrease).
+class AdaptiveLimit:
+    def __init__(self, maximum):
+        self.maximum=maximum
+        self.limit=float(maximum)
+        self.in_flight=0
+        self.decreased=0
+        self.condition=threading.Condition()
+
+    def __enter__(self):
+        with self.condition:
+            while self.in_flight>=int(self.limit):
+                self.condition.wait()
+            self.in_flight+=1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self.condition:
+            self.in_flight-=1
+            self.condition.notify()
+        return False
+
+    def success(self):
+        with self.condition:
+            if self.limit<self.maximum:
+                self.limit=min(self.maximum, self.limit+1/self.limit)
+                self.condition.notify_all()
+
+    def throttled(self):
+        with self.condition:
+            # several responses of the same burst count as one decrease
+            now=time.monotonic()
+            if now-self.decreased>1:
+                self.limit=max(1.0, self.limit/2)
+                self.decreased=now
+
+# create the shared session with a connection pool large enough for the workers
+def createSession():
+    new_session=requests.Session()
+    adapter=HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+    new_session.mount('https://', adapter)
+    new_session.mount('http://', adapter)
+    new_session.headers.update({ "Accept-Encoding" : "gzip, deflate", "Accept" : "application/json" })
+    return new_session
+
+session=createSession()
+
+# set the connect and read timeout for all requests
+def setTimeout(connect, read):
+    global TIMEOUT
+    TIMEOUT=(connect, read)
+
+# set the maximum number of parallel requests allowed against a host
+def setHostLimit(host, limit):
+    with host_limits_lock:
+        host_limits[host]=AdaptiveLimit(limit)
+
+# set the default number of parallel requests against a host, for hosts
+# without a limit from setHostLimit
+def setMaxPerHost(limit):
+    global MAX_PER_HOST
+    MAX_PER_HOST=limit
+
+# limit the requests in flight for the whole run, e.g. to the number of workers
+def setRequestBudget(limit):
+    global request_budget
+    request_budget=threading.BoundedSemaphore(limit)
+
+# return the limit (AdaptiveLimit) guarding the host of the given URL,
+# use it as context manager around the actual request
+def hostLimit(url):
+    host=urlparse(url).netloc
+    with host_limits_lock:
+        if host not in host_limits:
+            host_limits[host]=AdaptiveLimit(MAX_PER_HOST)
+        return host_limits[host]
+
+# return the token bucket of the endpoint of the URL. The endpoint is the host
+# and the first two path segments, e.g. iam.cloud.ibm.com/v1/apikeys, so all
+# key details share one bucket.
+def endpointBucket(url):
+    parts=urlparse(url)
+    endpoint=parts.netloc+'/'.join(parts.path.split('/')[:3])
+    with buckets_lock:
+        if endpoint not in buckets:
+            buckets[endpoint]=TokenBucket(RATE_LIMIT, max(1, RATE_LIMIT))
+        return buckets[endpoint]
+
+# seconds to wait before the next attempt, Retry-After (seconds or HTTP date)
+# if provided, else exponential backoff with full jitter
+def retryDelay(response, attempt):
+    retry_after=response.headers.get('Retry-After') if response is not None else None
+    if retry_after:
+        try:
+            return min(BACKOFF_MAX, max(0.0, float(retry_after)))
+        except ValueError:
+            try:
+                return min(BACKOFF_MAX, max(0.0, parsedate_to_datetime(retry_after).timestamp()-time.time()))
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE*2**attempt))
+
+# the URL to request, redirected to API_ENDPOINT if set
+def endpointURL(url):
+    if API_ENDPOINT is None:
+        return url
+    parts=urlparse(url)
+    return API_ENDPOINT.rstrip('/')+parts.path+('?'+parts.query if parts.query else '')
+
+# send one attempt of a request, recorded in the profile if enabled
+def sendRequest(method, url, headers, params, data, stream, retry):
+    if not profiler.enabled:
+        return session.request(method, url, headers=headers, params=params, data=data, timeout=TIMEOUT, stream=stream)
+    start=time.perf_counter()
+    response=None
+    try:
+        response=session.request(method, url, headers=headers, params=params, data=data, timeout=TIMEOUT, stream=stream)
+        return response
+    finally:
+        # the body of a streamed response is counted while it is read
+        profiler.request(endpointName(method, url), start, time.perf_counter()-start,
+                         response.status_code if response is not None else None,
+                         len(response.content) if response is not None and not stream else 0, retry)
+
+# send a request using the shared session, requests are paced per endpoint
+# and the number of parallel requests per host is limited. The token is either
+# the bearer token or a function returning it, like IAMtoken.TokenManager.
+# Throttled (429) and failed (5xx) requests as well as connection errors are
+# retried with backoff, a rejected token (401) once with a new token.
+# Any other error or running out of retries ends the script. For status codes
+# found in "messages", the related text is printed to give a hint about the cause.
+# With stream=True, the body is read only when accessed, e.g. by iterJSONMembers.
+def apiRequest(method, url, iam_token=None, headers=None, params=None, data=None, messages=None, stream=False):
+    all_headers={}
+    if headers is not None:
+        all_headers.update(headers)
+    url=endpointURL(url)
+    bucket=endpointBucket(url)
+    limit=hostLimit(url)
+    reauthenticated=False
+    try:
+        for attempt in range(MAX_RETRIES+1):
+            retry=attempt<MAX_RETRIES
+            bucket.take()
+            # a token manager (IAMtoken) hands out the current token for each attempt
+            if iam_token is not None:
+                all_headers["Authorization"]=iam_token() if callable(iam_token) else iam_token
+            countStat('requests')
+            try:
+                with request_budget, limit:
+                    response=sendRequest(method, url, all_headers, params, data, stream, attempt>0)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if not retry or (method!='GET' and not isinstance(e, requests.exceptions.ConnectTimeout)):
+                    raise
+                response=None
+            else:
+                if response.status_code==401 and hasattr(iam_token, 'invalidate') and not reauthenticated:
+                    # the token was rejected, e.g. revoked, retry once with a new one
+                    iam_token.invalidate()
+                    reauthenticated=True
+                    continue
+                if response.status_code==429:
+                    countStat('throttled')
+                    limit.throttled()
+                elif response.status_code not in RETRY_STATUS or method!='GET':
+                    limit.success()
+                    break
+                if not retry:
+                    break
+            delay=retryDelay(response, attempt)
+            countStat('retries')
+            countStat('backoff_seconds', delay)
+            if response is not None and response.status_code==429:
+                # all requests to the endpoint wait, including the next attempt
+                bucket.pause(delay)
+            else:
+                time.sleep(delay)
+
+        if messages is not None and response.status_code in messages:
+            print(messages[response.status_code])
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        raise SystemExit(e)
+    return response
+
+# the decoded JSON of a response, the time it takes is recorded in the profile
+def decodeJSON(response):
+    if not profiler.enabled:
+        return response.json()
+    start=time.perf_counter()
+    result=response.json()
+    profiler.decoded(endpointName(response.request.method, response.url), start, time.perf_counter()-start)
+    return result
+
+# GET request, return the decoded JSON
+def getJSON(url, iam_token=None, headers=None, params=None, messages=None):
+    return decodeJSON(apiRequest('GET', url, iam_token, headers, params, None, messages))
+
+# POST request, return the decoded JSON
+def postJSON(url, iam_token=None, headers=None, params=None, data=None, messages=None):
+    return decodeJSON(apiRequest('POST', url, iam_token, headers, params, data, messages))
+
+# parse the JSON object in the body of a streamed response while it is received
+# and yield its members as tuples (key, value). Members listed in "arrays" must
+# be arrays, they are yielded element by element as (key, element), so only
+# one element at a time is held in memory, not the whole document.
+def iterJSONMembers(response, arrays=()):
+    decoder=json.JSONDecoder()
+    name=endpointName(response.request.method, response.url) if profiler.enabled else None
+    decode_start=time.perf_counter()
+    decode_seconds=0.0
+
+    # the chunks of the body, counted for the profile
+    def chunks():
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            if name is not None:
+                profiler.received(name, len(chunk))
+            yield chunk
+
+    text=codecs.iterdecode(chunks(), response.encoding or 'utf-8')
+    buffer=''
+    pos=0
+
+    # append the next chunk, drop what is parsed already
+    def fill():
+        nonlocal buffer, pos
+        chunk=next(text, None)
+        if chunk is None:
+            return False
+        buffer=buffer[pos:]+chunk
+        pos=0
+        return True
+
+    # the next character that is not whitespace, consumed unless peek=True
+    def token(peek=False):
+        nonlocal pos
+        while True:
+            while pos<len(buffer) and buffer[pos] in ' \t\r\n':
+                pos+=1
+            if pos<len(buffer):
+                char=buffer[pos]
+                if not peek:
+                    pos+=1
+                return char
+            if not fill():
+                raise ValueError('unexpected end of JSON document')
+
+    # decode the next value, reading more of the body while it is incomplete
+    def value():
+        nonlocal pos, decode_seconds
+        token(peek=True)
+        while True:
+            start=time.perf_counter()
+            try:
+                result, end=decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                decode_seconds+=time.perf_counter()-start
+                if not fill():
+                    raise
+                continue
+            decode_seconds+=time.perf_counter()-start
+            # a number at the end of the buffer might continue in the next chunk
+            if end==len(buffer) and fill():
+                continue
+            pos=end
+            return result
+
+    # the decode time is recorded as one event once the document is parsed
+    try:
+        if token()!='{':
+            raise ValueError('expected a JSON object')
+        while True:
+            char=token(peek=True)
+            if char=='}':
+                return
+            if char==',':
+                token()
+            key=value()
+            if token()!=':':
+                raise ValueError('expected ":" after {}'.format(key))
+            if key not in arrays:
+                yield key, value()
+                continue
+            if token()!='[':
+                raise ValueError('expected an array for {}'.format(key))
+            while True:
+                char=token(peek=True)
+                if char==']':
+                    token()
+                    break
+                if char==',':
+                    token()
+                yield key, value()
+    finally:
+        if name is not None:
+            profiler.decoded(name, decode_start, decode_seconds)
+
+# yield the pages of a paginated listing. getPage(cursor) retrieves a page,
+# starting with the given cursor (None for the first page), and nextCursor(page)
+# returns the cursor for the following page or None on the last page. While
+# the caller processes a page, the next one is already retrieved in the background.
+def iterPages(getPage, nextCursor, cursor=None):
+    executor=ThreadPoolExecutor(max_workers=1)
+    future=executor.submit(getPage, cursor)
+    try:
+        while future is not None:
+            page=future.result()
+            cursor=nextCursor(page)
+            future=executor.submit(getPage, cursor) if cursor is not None else None
+            yield page
+    finally:
+        if future is not None:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+# consume each of the iterables in its own thread and yield all their items,
+# first those of the first iterable, then those of the second and so on. The
+# later ones are retrieved in the background meanwhile, so the wall time is
+# close to that of the slowest iterable and not the sum of all.
+def chainConcurrently(iterables):
+    done=object()
+    def produce(iterable, items):
+        try:
+            for item in iterable:
+                items.put((item, None))
+        except BaseException as e:
+            items.put((None, e))
+        finally:
+            items.put((done, None))
+
+    queues=[]
+    for iterable in iterables:
+        items=queue.Queue()
+        threading.Thread(target=produce, args=(iterable, items), daemon=True).start()
+        queues.append(items)
+    for items in queues:
+        while True:
+            item, error=items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                break
+            yield item
+
+# apply func to each item using up to "workers" threads and yield tuples of
+# (item, result) in the original order of the items. A result is handed out
+# as soon as it and all results before it are available, so output can be
+# printed while the remaining requests are still running. Only a window of
+# 2*workers requests is submitted at a time, so long lists don't pile up.
+def fetchOrdered(func, items, workers=1):
+    if workers is None or workers<=1:
+        for item in items:
+            yield item, func(item)
+        return
+
+    pending=deque()
+    executor=ThreadPoolExecutor(max_workers=workers)
+    try:
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending)>=2*workers:
+                item, future=pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future=pending.popleft()
+            yield item, future.result()
+    finally:
+        # on errors or early exit, don't start what is still queued
+        for item, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
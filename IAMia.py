@@ -6,13 +6,37 @@
 # Written by Henrik Loeser, hloeser@de.ibm.com
 #            Dimitri Prosper, dimitri_prosper@us.ibm.com
 
-# only standard packages are used, no installation necessary
-import requests, json, sys,os, base64
+# only the requests package is used, no other installation necessary
+import json, sys,os, base64, csv, time
 import argparse 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from urllib.parse import urlparse,parse_qs
+from IAMclient import apiRequest, decodeJSON, fetchOrdered, getJSON, iterJSONMembers, iterPages, postJSON
+from IAMtoken import TokenManager
+from IAMindex import buildIdentityIndex
+from IAMpolicies import iterPolicyRecords
+from IAMoutput import INACTIVE_IDENTITIES, JSONWriter, TableWriter
+from IAMcache import DetailsCache, Journal, Snapshot
+from IAMprofile import profiled, profiler
 
 
-json_apikeys=[]
+# the sections of the report with the identities, in the order of the CSV output
+REPORT_SECTIONS=('apikeys','profiles','users')
+
+# polling a triggered report (--action run): first interval and upper bound
+# in seconds, growth factor, and how long to wait at most
+POLL_START=1
+POLL_MAX=30
+POLL_FACTOR=1.5
+POLL_TIMEOUT=1800
+
+# optional cache for API key and trusted profile details (DetailsCache), enabled by --cache
+details_cache=None
+# state of the previous run (Snapshot), enabled by --since-last
+snapshot=None
+# progress of an advanced level run (Journal) to resume it with --resume
+journal=None
 
 # read an API key from a JSON file
 def readApiKey(filename):
@@ -21,138 +45,358 @@ def readApiKey(filename):
     api_key = credentials.get('apikey')
     return api_key
 
-# obtain an access token from an IAM API key
-def getAuthTokens(api_key):
-    url     = "https://iam.cloud.ibm.com/identity/token"
-    headers = { "Content-Type" : "application/x-www-form-urlencoded" }
-    data    = "apikey=" + api_key + "&grant_type=urn:ibm:params:oauth:grant-type:apikey"
-    try:
-        response  = requests.post( url, headers=headers, data=data )
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e: 
-        raise SystemExit(e)
-    return response.json()
-
 # retrieve details about an API key
 def getIAMDetails(api_key, iam_token):
     url     = "https://iam.cloud.ibm.com/v1/apikeys/details"
-    headers = { "Authorization" : iam_token, "IAM-Apikey" : api_key, "Content-Type" : "application/json" }
-    try:
-        response  = requests.get( url, headers=headers )
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        raise SystemExit(e)
-    return response.json()
+    headers = { "IAM-Apikey" : api_key, "Content-Type" : "application/json" }
+    return getJSON(url, iam_token, headers=headers)
 
 # get the details for an API key, including history and activities
 def getApiKeyDetails(iam_token, apikey_id):
     url = 'https://iam.cloud.ibm.com/v1/apikeys/{}'.format(apikey_id)
-    headers = { "Authorization" : iam_token }
     # we want activity included
     payload={"include_activity":True}
-    try:
-        response = requests.get(url, headers=headers, params=payload)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        raise SystemExit(e)
-
-    return response.json()
+    if details_cache is not None:
+        return details_cache.getDetails('apikey', apikey_id, url, iam_token, payload)
+    return getJSON(url, iam_token, params=payload)
 
 # get the details for a trusted profile, including activities
 def getTrustedProfileDetails(iam_token, profile_id):
     url = 'https://iam.cloud.ibm.com/v1/profiles/{}'.format(profile_id)
-    headers = { "Authorization" : iam_token }
     # we want activity included
     payload={"include_activity":True}
-    try:
-        response = requests.get(url, headers=headers, params=payload)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        raise SystemExit(e)
+    if details_cache is not None:
+        return details_cache.getDetails('profile', profile_id, url, iam_token, payload)
+    return getJSON(url, iam_token, params=payload)
 
-    return response.json()
+# retrieve an IAM Inactive Identities Report, None if it is not available yet (204).
+# With stream=True, the report is parsed while it is received, see getReportResponse.
+def getReport(iam_token, account_id, report_id, stream=False):
+    return getReportResponse(iam_token, account_id, report_id, stream)[0]
 
-# loop over the IAM Inactive Identities Report (apikeys / users / trusted profiles) ID and retrieve the details
-def getAndPrintInactiveIdentitiesReport(iam_token, account_id, iam_id, report_id, level, out_format):
+# the report (None if not available yet) and the response it was taken from.
+# With stream=True, the report is not loaded as a whole, instead an iterator
+# of its members as (key, value) is returned, the entries of apikeys, profiles
+# and users are yielded one by one as (section, entry).
+def getReportResponse(iam_token, account_id, report_id, stream=False):
     url = 'https://iam.cloud.ibm.com/v1/activity/accounts/{}/report/{}'.format(account_id,report_id)
-    headers = { "Authorization" : iam_token, "Content-Type" : "application/json" }
-    try:
-        response = requests.get(url, headers=headers)
-        # handle some known issues
-        if response.status_code == 404:
-            print("The requested report might have been replaced with a newer one or a wrong ID was provided.")
-        elif response.status_code == 204:
-            print("The requested report might not be available yet. Try again shortly.")
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        raise SystemExit(e)
-
-    result=response.json()
+    headers = { "Content-Type" : "application/json" }
+    # handle some known issues
+    messages = { 404 : "The requested report might have been replaced with a newer one or a wrong ID was provided." }
+    response=apiRequest('GET', url, iam_token, headers=headers, messages=messages, stream=stream)
+    if response.status_code==204:
+        return None, response
+    if stream:
+        return iterJSONMembers(response, REPORT_SECTIONS), response
+    return decodeJSON(response), response
+
+# poll a triggered report until it is available and return it. The interval
+# starts short and grows with each attempt, so a quick report is picked up
+# within seconds while a long generation doesn't cause a flood of requests.
+# A Retry-After header sent with the response is honored instead.
+def waitForReport(iam_token, account_id, report_id, timeout=POLL_TIMEOUT, stream=False):
+    deadline=time.monotonic()+timeout
+    interval=POLL_START
+    while True:
+        result, response=getReportResponse(iam_token, account_id, report_id, stream)
+        if result is not None:
+            return result
+        delay=interval
+        if response.headers.get('Retry-After', '').isdigit():
+            delay=int(response.headers['Retry-After'])
+        if time.monotonic()+delay>deadline:
+            raise SystemExit("The report {} is not available after {} seconds.".format(report_id, timeout))
+        time.sleep(delay)
+        interval=min(POLL_MAX, interval*POLL_FACTOR)
+
+# retrieve an existing IAM Inactive Identities Report and print it
+def getAndPrintInactiveIdentitiesReport(iam_token, account_id, iam_id, report_id, level, out_format, workers=1, users=None, stream=False, export=None):
+    result=getReport(iam_token, account_id, report_id, stream)
+    if result is None:
+        raise SystemExit("The requested report might not be available yet. Try again shortly or use --action run to wait for it.")
+    printInactiveIdentitiesReport(iam_token, result, level, out_format, workers, users, export)
+
+# wait for a triggered report and print it as soon as it is available.
+# Meanwhile, the users index for the email addresses is built (emails=True).
+def waitAndPrintInactiveIdentitiesReport(iam_token, account_id, report_id, level, out_format, workers=1, emails=False, timeout=POLL_TIMEOUT, stream=False, export=None):
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        users=executor.submit(buildIdentityIndex, iam_token, account_id) if emails else None
+        result=waitForReport(iam_token, account_id, report_id, timeout, stream)
+        users=users.result() if users is not None else None
+    printInactiveIdentitiesReport(iam_token, result, level, out_format, workers, users, export)
+
+# the entries of a report as tuples (section, entry). A loaded report is
+# ordered by section, a streamed one (iterator of members) keeps the order of
+# the document, its other members like the account ID are skipped.
+def reportEntries(result):
+    if isinstance(result, dict):
+        return ((section, item) for section in REPORT_SECTIONS for item in result.get(section,[]))
+    return ((key, value) for key, value in result if key in REPORT_SECTIONS)
 
+# loop over the IAM Inactive Identities Report (apikeys / users / trusted profiles) ID and retrieve the details
+# with a users index (IdentityIndex), the email address of the API key creator is added for the advanced level.
+# The report is either loaded (dict) or streamed (see getReportResponse), then each entry
+# is printed while the report is still parsed. With an export prefix, the entries are
+# exported as table instead (TableWriter).
+def printInactiveIdentitiesReport(iam_token, result, level, out_format, workers=1, users=None, export=None):
     # only dump the original report for standard level
-    if out_format=='JSON' and level=='standard':
+    if out_format=='JSON' and level=='standard' and export is None:
+        # in delta mode, only keep identities added, changed or removed since the last run
+        if snapshot is not None:
+            result=filterReportChanges(result)
         print(json.dumps(result, indent=2))
         return
 
+    entries=reportEntries(result)
+    # in delta mode, only keep identities added or changed since the last run
+    if snapshot is not None:
+        entries=selectReportChanges(entries)
+    # when resuming, skip the identities reported before
+    if journal is not None:
+        entries=((section, item) for section, item in entries if not journal.isDone(reportItemId(section, item)))
+
+    # for the advanced level, details are looked up (in parallel with workers>1),
+    # for the standard level there is nothing to look up
+    if level=='standard':
+        lookup=lambda entry: None
+        workers=1
+    else:
+        lookup=lambda entry: lookupDetails(iam_token, entry[0], entry[1])
+
     # go over the individual parts of the report
     # - look up details if advanced level requested
-    # - convert to CSV
-    print('iam_id,name,last_authn,type,id,name,username,email,created_by,created_at,locked,authn_count')
-    for apikey in result['apikeys']:
-         if apikey['type']=='serviceid':
-            if level=='standard':
-               print("{},{},{},{},{},{}".format(apikey['id'],apikey['name'], apikey.get('last_authn',None), 
-                     apikey['type'], apikey['serviceid']['id'], apikey['serviceid']['name'] ))
-            else:
-               apikey_details=getApiKeyDetails(iam_token, apikey['id'])
-               print("{},{},{},{},{},{},{},{},{},{},{},{}".format(apikey['id'], apikey['name'], apikey.get('last_authn',None), 
-                     apikey['type'], apikey['serviceid']['id'], apikey['serviceid']['name'], 
-                     '','',
-                     apikey_details['created_by'], apikey_details['created_at'], apikey_details['locked'], apikey_details.get('activity',{}).get('authn_count', None) ))
-
-         if apikey['type']=='user':
-            if level=='standard':
-               print("{},{},{},{},{},{},{},{}".format(apikey['id'],apikey['name'], apikey.get('last_authn',None), 
-                     apikey['type'], apikey['user']['iam_id'], apikey['user']['name'], 
-                     apikey['user']['username'], apikey['user']['email'] ))
+    # - convert to CSV or NDJSON
+    # the creator's email address is only added as extra column if requested,
+    # in delta mode the kind of change is the first column
+    enrich=users is not None and level=='advanced'
+    prefix=lambda item: item['change']+',' if snapshot is not None else ''
+    writer=None
+    if export is not None:
+        writer=TableWriter(export, INACTIVE_IDENTITIES)
+    elif out_format=='NDJSON':
+        writer=JSONWriter(ndjson=True)
+    if writer is None and (journal is None or not journal.resumed):
+        print(('change,' if snapshot is not None else '')+'iam_id,name,last_authn,type,id,name,username,email,created_by,created_at,locked,authn_count'+(',created_by_email' if enrich else ''))
+    with writer if writer is not None else nullcontext():
+        for (section, item), details in fetchOrdered(lookup, entries, workers):
+            if isinstance(writer, TableWriter):
+                writer.write(identityRecord(section, item, details, users if enrich else None))
+            elif writer is not None:
+                writer.write(reportRecord(section, item, details, users if enrich else None))
+            elif section=='apikeys':
+                printApiKeyRow(item, details, level, prefix(item), users if enrich else None)
+            elif section=='profiles':
+                printProfileRow(item, details, level, prefix(item))
             else:
-               apikey_details=getApiKeyDetails(iam_token, apikey['id'])
-               print("{},{},{},{},{},{},{},{},{},{},{},{}".format(apikey['id'],apikey['name'], apikey.get('last_authn',None), 
-                     apikey['type'], apikey['user']['iam_id'], apikey['user']['name'], 
-                     apikey['user']['username'], apikey['user']['email'],
-                     apikey_details['created_by'], apikey_details['created_at'], apikey_details['locked'], apikey_details.get('activity',{}).get('authn_count', None) ))
-
-    for profile in result['profiles']:
-         if level=='standard':
-            print("{},{},{}".format(profile['id'], profile['name'], profile.get('last_authn',None) ))
-         else:
-            trusted_profile_details=getTrustedProfileDetails(iam_token, profile['id'])
-            print("{},{},{},{},{},{},{},{},{},{},{},{}".format(profile['id'], profile['name'], profile.get('last_authn',None), 
-                  '','','',
-                  '', '',
-                  '', trusted_profile_details['created_at'], '', trusted_profile_details.get('activity',{}).get('authn_count', None) ))
-
-    for user in result['users']:
-         if level=='standard':
-            print("{},{},{},{},{},{},{},{}".format(user['iam_id'], user['name'], user.get('last_authn',None),
-                  '','','', 
-                  user['username'], user['email'] ))
-         else:
-            print("{},{},{},{},{},{},{},{}".format(user['iam_id'], user['name'], user.get('last_authn',None),
-                  '','','', 
-                  user['username'], user['email'] ))
+                printUserRow(item, prefix(item))
+            # the journal records each identity once it is printed
+            if journal is not None:
+                journal.markDone(reportItemId(section, item))
+
+        # in delta mode, list the identities of the last run which are gone
+        if snapshot is not None:
+            for item_id, item in snapshot.removed():
+                item['change']='removed'
+                if isinstance(writer, TableWriter):
+                    writer.write(identityRecord(item_id.split('/')[0], item, None))
+                elif writer is not None:
+                    writer.write(dict(item, section=item_id.split('/')[0]))
+                else:
+                    print("removed,{},{},{}".format(item.get('id', item.get('iam_id')), item.get('name'), item.get('last_authn',None)))
+            snapshot.save()
+
+# the details for an entry of the report, None if there are none to look up
+def lookupDetails(iam_token, section, item):
+    if section=='apikeys':
+        return getApiKeyDetails(iam_token, item['id']) if item['type'] in ('serviceid','user') else None
+    if section=='profiles':
+        return getTrustedProfileDetails(iam_token, item['id'])
+    return None
+
+# an entry of the report as NDJSON record, with the section it is from and
+# the details if looked up (advanced level)
+@profiled('format')
+def reportRecord(section, item, details, users=None):
+    record=dict(item, section=section)
+    if details is not None:
+        record['details']=details
+        if users is not None and 'created_by' in details:
+            record['created_by_email']=users.email(details['created_by'])
+    return record
+
+# an entry of the report as record of the INACTIVE_IDENTITIES schema for the
+# export. The owner is the service ID or user of an API key.
+@profiled('format')
+def identityRecord(section, item, details, users=None):
+    record={"change": item.get('change'), "section": section, "iam_id": item['iam_id'] if section=='users' else item['id'],
+            "name": item.get('name'), "last_authn": item.get('last_authn')}
+    if section=='apikeys':
+        owner=item.get(item.get('type'), {})
+        record.update({"type": item.get('type'), "owner_id": owner.get('iam_id', owner.get('id')), "owner_name": owner.get('name'),
+                       "username": owner.get('username'), "email": owner.get('email')})
+    elif section=='users':
+        record.update({"username": item.get('username'), "email": item.get('email')})
+    if details is not None:
+        record.update({"created_by": details.get('created_by'), "created_at": details.get('created_at'),
+                       "locked": details.get('locked'), "authn_count": details.get('activity',{}).get('authn_count')})
+        if users is not None and details.get('created_by'):
+            record['created_by_email']=users.email(details['created_by'])
+    return record
+
+# print an API key of the report as CSV line, with a users index the email
+# address of the creator is added
+@profiled('format')
+def printApiKeyRow(apikey, apikey_details, level, prefix, users=None):
+    if apikey['type']=='serviceid':
+       if level=='standard':
+          print(prefix+"{},{},{},{},{},{}".format(apikey['id'],apikey['name'], apikey.get('last_authn',None), 
+                apikey['type'], apikey['serviceid']['id'], apikey['serviceid']['name'] ))
+       else:
+          print(prefix+"{},{},{},{},{},{},{},{},{},{},{},{}".format(apikey['id'], apikey['name'], apikey.get('last_authn',None), 
+                apikey['type'], apikey['serviceid']['id'], apikey['serviceid']['name'], 
+                '','',
+                apikey_details['created_by'], apikey_details['created_at'], apikey_details['locked'], apikey_details.get('activity',{}).get('authn_count', None) )
+                +(",{}".format(users.email(apikey_details['created_by'])) if users is not None else ''))
+
+    if apikey['type']=='user':
+       if level=='standard':
+          print(prefix+"{},{},{},{},{},{},{},{}".format(apikey['id'],apikey['name'], apikey.get('last_authn',None), 
+                apikey['type'], apikey['user']['iam_id'], apikey['user']['name'], 
+                apikey['user']['username'], apikey['user']['email'] ))
+       else:
+          print(prefix+"{},{},{},{},{},{},{},{},{},{},{},{}".format(apikey['id'],apikey['name'], apikey.get('last_authn',None), 
+                apikey['type'], apikey['user']['iam_id'], apikey['user']['name'], 
+                apikey['user']['username'], apikey['user']['email'],
+                apikey_details['created_by'], apikey_details['created_at'], apikey_details['locked'], apikey_details.get('activity',{}).get('authn_count', None) )
+                +(",{}".format(users.email(apikey_details['created_by'])) if users is not None else ''))
+
+# print a trusted profile of the report as CSV line
+@profiled('format')
+def printProfileRow(profile, trusted_profile_details, level, prefix):
+    if level=='standard':
+       print(prefix+"{},{},{}".format(profile['id'], profile['name'], profile.get('last_authn',None) ))
+    else:
+       print(prefix+"{},{},{},{},{},{},{},{},{},{},{},{}".format(profile['id'], profile['name'], profile.get('last_authn',None), 
+             '','','',
+             '', '',
+             '', trusted_profile_details['created_at'], '', trusted_profile_details.get('activity',{}).get('authn_count', None) ))
+
+# print a user of the report as CSV line
+@profiled('format')
+def printUserRow(user, prefix):
+    print(prefix+"{},{},{},{},{},{},{},{}".format(user['iam_id'], user['name'], user.get('last_authn',None),
+          '','','', 
+          user['username'], user['email'] ))
+
+# the identifier of an entry in the report sections apikeys, profiles and users
+def reportItemId(section, item):
+    return section+'/'+(item['iam_id'] if section=='users' else item['id'])
+
+# yield the entries (section, entry) of the report which were added or changed
+# since the last run, based on their last authentication. Each entry gets its
+# kind of change. The new state is stored by snapshot.save().
+def selectReportChanges(entries):
+    for section, item in entries:
+        item['change']=snapshot.check(reportItemId(section, item), item.get('last_authn'), item)
+        if item['change'] is not None:
+            yield section, item
+
+# keep only the entries of the loaded report which were added or changed since
+# the last run, the entries of the last run no longer in the report are listed
+# as "removed". The new state is stored for the next run.
+def filterReportChanges(result):
+    for section in REPORT_SECTIONS:
+        result[section]=[item for s, item in selectReportChanges((section, item) for item in result.get(section,[]))]
+    result['removed']=[]
+    for item_id, item in snapshot.removed():
+        item['change']='removed'
+        result['removed'].append(item)
+    snapshot.save()
+    return result
+
+# the IAM ID of an entry in the report, for API keys the one of the user or
+# service ID owning the key. Service IDs and trusted profiles have the IAM ID
+# "iam-" followed by their ID.
+def reportIamId(section, item):
+    if section=='users':
+        return item['iam_id']
+    if section=='profiles':
+        return item.get('iam_id', 'iam-'+item['id'])
+    owner=item.get(item.get('type'), {})
+    if item.get('type')=='user':
+        return owner.get('iam_id')
+    return owner.get('iam_id', 'iam-'+owner['id']) if 'id' in owner else None
+
+# the IAM IDs of the members of an access group
+def getAccessGroupMembers(iam_token, group_id):
+    pagesize=100
+    url = 'https://iam.cloud.ibm.com/v2/groups/{}/members'.format(group_id)
+    def getPage(offset):
+        return getJSON(url, iam_token, params={"limit": pagesize, "offset": offset or 0})
+    nextOffset=lambda page: page['offset']+page['limit'] if 'next' in page else None
+    return [member['iam_id'] for page in iterPages(getPage, nextOffset) for member in page.get('members',[])]
+
+# hash indexes of the access policies (IAMrecords.Policy) by the IAM ID and by
+# the access group of their subject, so the policies of an identity are found
+# without scanning all policies for each identity
+def indexPolicies(policies):
+    by_iam_id={}
+    by_group={}
+    for policy in policies:
+        for key, value in policy.subjects:
+            if key=='iam_id':
+                by_iam_id.setdefault(value, []).append(policy)
+            elif key=='access_group_id':
+                by_group.setdefault(value, []).append(policy)
+    return by_iam_id, by_group
+
+# print the entries of the report together with the access policies they hold,
+# directly or through an access group, one row per identity and policy.
+# The report and the policies are retrieved concurrently, the memberships only
+# for the access groups with policies (in parallel with workers>1). The join
+# itself is a single pass over the report with lookups in the indexes. All
+# access policies are held in memory for it, as compact records.
+def joinReportPolicies(iam_token, account_id, report_id, out_format, workers=1, timeout=None):
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        indexes=executor.submit(lambda: indexPolicies(iterPolicyRecords(iam_token, account_id, 'access')))
+        if timeout is not None:
+            result=waitForReport(iam_token, account_id, report_id, timeout, stream=True)
+        else:
+            result=getReport(iam_token, account_id, report_id, stream=True)
+            if result is None:
+                raise SystemExit("The requested report might not be available yet. Try again shortly or use --action run to wait for it.")
+        # the policies are needed from the first entry on, the rest of the report is streamed
+        entries=reportEntries(result)
+        by_iam_id, by_group=indexes.result()
+    member_of={}
+    for group_id, members in fetchOrdered(lambda group_id: getAccessGroupMembers(iam_token, group_id), list(by_group), workers):
+        for member in members:
+            member_of.setdefault(member, []).append(group_id)
+
+    columns=['section','id','name','last_authn','iam_id','via','policy_id','role_id','resource_key','resource_value','last_permit_at','last_permit_frequency']
+    out=csv.writer(sys.stdout) if out_format=='CSV' else None
+    writer=JSONWriter(ndjson=out_format=='NDJSON') if out is None else None
+    if out is not None:
+        out.writerow(columns)
+    with writer if writer is not None else nullcontext():
+        for section, item in entries:
+            iam_id=reportIamId(section, item)
+            held=[(None, policy) for policy in by_iam_id.get(iam_id, [])]
+            held+=[(group_id, policy) for group_id in member_of.get(iam_id, []) for policy in by_group[group_id]]
+            for via, policy in held:
+                resource_key, resource_value=policy.resources[0]
+                row=[section, item['iam_id'] if section=='users' else item['id'], item.get('name'), item.get('last_authn'), iam_id,
+                     via, policy.id, policy.roles[0], resource_key, resource_value,
+                     policy.last_permit_at, policy.last_permit_frequency]
+                if out is not None:
+                    out.writerow(row)
+                else:
+                    writer.write(dict(zip(columns, row)))
 
 # trigger an activity report
 def triggerReport(iam_token, account_id, duration):
     url = 'https://iam.cloud.ibm.com/v1/activity/accounts/{}/report?duration={}'.format(account_id,duration)
-    headers = { "Authorization" : iam_token }
-    try:
-        response = requests.post(url, headers=headers)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        raise SystemExit(e)
-
-    return response.json()
+    return postJSON(url, iam_token)
 
 # use split and base64 to get to the content of the IAM token
 def extractAccount(iam_token):
@@ -170,17 +414,44 @@ if __name__== "__main__":
 
     # define the command line arguments
     parser = argparse.ArgumentParser(description='Retrieve information from IAM Inactive Identities report in an IBM Cloud account')
-    parser.add_argument('--action', choices=['trigger','get'], dest='action', default='get',
-                        help='trigger or get a report')
-    parser.add_argument('--output', choices=['CSV','JSON'], dest='out_format', default='CSV',
-                        help='return output in CSV or JSON format')
+    parser.add_argument('--action', choices=['trigger','get','run'], dest='action', default='get',
+                        help='trigger or get a report, or trigger a report and get it once available (run)')
+    parser.add_argument('--output', choices=['CSV','JSON','NDJSON'], dest='out_format', default='CSV',
+                        help='return output in CSV, JSON or newline-delimited JSON format')
+    parser.add_argument('--export', type=str, dest='export', metavar='PREFIX', help='export the identities as table to PREFIX.parquet (with pyarrow) or PREFIX.csv.gz instead of printing them')
+    parser.add_argument('--policies', action='store_true', dest='policies', help='list the access policies each identity holds, directly or through access groups')
+    parser.add_argument('--stream', action='store_true', dest='stream', help='parse the report while it is received and print each identity right away, in the order of the report')
     parser.add_argument('--credentials', type=str, action='store', dest='credfile', help='credential file to use')
     parser.add_argument('--duration', type=int, dest='duration', default=0, help='Optional duration of the report, supported unit of duration is hours')
     parser.add_argument('--level', choices=['standard','advanced'], dest='level', default='standard', 
                         help='Retrieve information from the report only (standard) or more detailed - takes longer to run - leveraging the APIs (advanced).')
+    parser.add_argument('--wait', type=int, dest='wait', default=POLL_TIMEOUT, help='seconds to wait at most for the report to be available (run)')
     parser.add_argument('--reportid', type=str, action='store', dest='reportid', default='latest', help='the report to retrieve')
+    parser.add_argument('--workers', type=int, dest='workers', default=1, help='number of details to retrieve in parallel (advanced level)')
+    parser.add_argument('--cache', action=argparse.BooleanOptionalAction, dest='cache', default=False, help='reuse details cached by previous runs (advanced level)')
+    parser.add_argument('--cache-ttl', type=float, dest='cache_ttl', metavar='SECONDS', help='reuse cached details up to this age, default 3600 or IAM_CACHE_TTL')
+    parser.add_argument('--since-last', action='store_true', dest='since_last', help='only report identities added, changed or removed since the last run with this option')
+    parser.add_argument('--resume', action='store_true', dest='resume', help='continue an interrupted run of the advanced level without repeating reported identities')
+    parser.add_argument('--emails', action='store_true', dest='emails', help='add the email address of the API key creator (advanced level), requires the privilege to list users')
+    parser.add_argument('--profile', nargs='?', const='', dest='profile', metavar='TRACE_FILE', help='print a profile of the requests per endpoint at the end, optionally write a timeline in Chrome trace format to TRACE_FILE')
     # parse the parameters
     args = parser.parse_args()
+    if args.profile is not None:
+        profiler.enable(args.profile or None)
+    if args.resume and args.since_last:
+        parser.error('--resume cannot be combined with --since-last')
+    if args.policies and (args.since_last or args.resume or args.export or args.out_format=='JSON'):
+        parser.error('--policies supports CSV and NDJSON output and cannot be combined with --since-last, --resume or --export')
+    if args.resume and args.export:
+        parser.error('--resume cannot be combined with --export')
+    if args.stream and args.out_format=='JSON' and not args.export:
+        parser.error('--stream requires CSV or NDJSON output')
+    if args.resume and (args.action=='run' or args.reportid=='latest'):
+        parser.error('--resume continues a report with --action get --reportid ID')
+    if args.resume and args.out_format=='JSON':
+        parser.error('--resume requires CSV or NDJSON output')
+    if args.resume and args.level!='advanced':
+        parser.error('--resume continues a run of the advanced level')
 
     # do we have any parameters like the credential file?
     # if not, let's try to obtain the token from environment
@@ -197,10 +468,8 @@ if __name__== "__main__":
     else:
         # read credentials from file 
         apiKey=readApiKey(args.credfile)
-        # create the IAM access token
-        authTokens=getAuthTokens(api_key=apiKey)
-        # and make it a bearer token
-        iam_token='Bearer '+authTokens["access_token"]   
+        # the IAM access token, reused from previous runs and refreshed before it expires
+        iam_token=TokenManager(apiKey)
 
 
         # get account details
@@ -213,7 +482,32 @@ if __name__== "__main__":
         report=triggerReport(iam_token, account_id, args.duration)
         report_id=report['reference']
         print("The report ID is: {}".format(report_id))
-    # retrieve an existing report
-    elif args.action=='get':
-        getAndPrintInactiveIdentitiesReport(iam_token, account_id, iam_id, args.reportid, args.level, args.out_format)
-        
+    # retrieve an existing report, or trigger a new one and wait for it
+    else:
+        report_id=args.reportid
+        if args.action=='run':
+            report_id=triggerReport(iam_token, account_id, args.duration)['reference']
+            # stdout is for the report, an interrupted run can be continued with this ID
+            print("The report ID is: {}".format(report_id), file=sys.stderr)
+        if args.policies:
+            joinReportPolicies(iam_token, account_id, report_id, args.out_format, args.workers, args.wait if args.action=='run' else None)
+            sys.exit()
+        if args.cache:
+            details_cache=DetailsCache(args.cache_ttl)
+        if args.since_last:
+            snapshot=Snapshot('IAMia/{}'.format(account_id))
+        # "latest" might be another report when resumed, only runs of a report ID
+        # with output which can be continued are journaled
+        elif args.level=='advanced' and report_id!='latest' and args.out_format!='JSON' and args.export is None:
+            journal=Journal('IAMia/{}/{}'.format(account_id, report_id), args.resume)
+        if args.action=='run':
+            waitAndPrintInactiveIdentitiesReport(iam_token, account_id, report_id, args.level, args.out_format, args.workers, args.emails, args.wait, args.stream, args.export)
+        else:
+            users=buildIdentityIndex(iam_token, account_id) if args.emails else None
+            getAndPrintInactiveIdentitiesReport(iam_token, account_id, iam_id, report_id, args.level, args.out_format, args.workers, users, args.stream, args.export)
+        if details_cache is not None:
+            details_cache.close()
+        if snapshot is not None:
+            snapshot.close()
+        if journal is not None:
+            journal.finish()
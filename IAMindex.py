@@ -0,0 +1,70 @@
+# Index of the users in an IBM Cloud account, built once per run. It maps the
+# IAM ID to a compact record with email, name and username. Enriching values
+# like "created_by", "created_by_id" or the IAM ID of a policy subject is then
+# a dictionary lookup instead of a scan over all users.
+
+from IAMclient import getJSON, iterPages
+
+
+# compact record of a user, only the fields needed for enrichment
+class Identity:
+    __slots__=('email','name','username')
+
+    def __init__(self, email, name, username):
+        self.email=email
+        self.name=name
+        self.username=username
+
+# map of IAM ID to Identity. It can be filled from the user management API
+# (firstname, lastname, user_id) or from the users in an inactive identities
+# report (name, username).
+class IdentityIndex:
+    def __init__(self, users=()):
+        self.identities={}
+        for user in users:
+            self.add(user)
+
+    def add(self, user):
+        name=user.get('name')
+        if name is None:
+            name=' '.join(filter(None, [user.get('firstname'), user.get('lastname')])) or None
+        self.identities[user['iam_id']]=Identity(user.get('email'), name, user.get('username', user.get('user_id')))
+
+    def __len__(self):
+        return len(self.identities)
+
+    def __contains__(self, iam_id):
+        return iam_id in self.identities
+
+    def get(self, iam_id):
+        return self.identities.get(iam_id)
+
+    def email(self, iam_id):
+        identity=self.identities.get(iam_id)
+        return identity.email if identity is not None else None
+
+    def name(self, iam_id):
+        identity=self.identities.get(iam_id)
+        return identity.name if identity is not None else None
+
+    def username(self, iam_id):
+        identity=self.identities.get(iam_id)
+        return identity.username if identity is not None else None
+
+# retrieve users in the account, one page after the other. The users are
+# yielded as they arrive, the next page is retrieved in the background.
+# The user management API allows up to 100 users per page.
+def iterUsers(iam_token, account_id):
+    pagesize=100
+    base_url = 'https://user-management.cloud.ibm.com'
+    def getPage(next_url):
+        if next_url is None:
+            url=base_url+'/v2/accounts/'+account_id+'/users'
+            return getJSON(url, iam_token, params={"limit": pagesize})
+        return getJSON(base_url+next_url, iam_token)
+    for page in iterPages(getPage, lambda page: page.get('next_url')):
+        yield from page['resources']
+
+# build the index from the users in the account, the user list is streamed
+def buildIdentityIndex(iam_token, account_id):
+    return IdentityIndex(iterUsers(iam_token, account_id))
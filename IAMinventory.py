@@ -0,0 +1,365 @@
+# Small script to keep a local inventory of an IBM Cloud account in SQLite:
+# API keys, service IDs, users, access policies and the inactive identities
+# report. "sync" retrieves all of them (concurrently) and replaces the stored
+# data of the account, "query" runs SQL against the stored data, so ad-hoc
+# questions don't need another crawl of the APIs. "serve" keeps running: it
+# syncs on a schedule with one session and token, only writes what changed and
+# serves metrics about the inventory on a local port in the Prometheus text
+# format, e.g. for dashboards and alerts.
+# The database is inventory.sqlite in the cache directory (~/.cache/ibmcloud-iam
+# or IAM_CACHE_DIR), readable only by the user.
+
+# only the requests package is used, no other installation necessary
+import json, sys,os, base64, csv, time, threading
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from IAMtoken import TokenManager
+from IAMindex import iterUsers
+from IAMoutput import JSONWriter, parseTimestamp
+from IAMcache import openDatabase
+from IAMkeys import iterApiKeyPages, iterServiceIDs
+from IAMpolicies import iterPoliciesV2
+from IAMia import getReport, reportEntries
+from IAMprofile import profiler
+
+
+DATASETS=['apikeys','serviceids','users','policies','activity']
+# buckets (upper bounds in days) for the time since the last authentication
+INACTIVITY_BUCKETS=[30, 90, 180, 365]
+
+# tables with the list-level fields as columns and the full record as JSON
+# in "data", e.g. for json_extract(). Timestamps are stored as ISO 8601 in UTC.
+TABLES='''
+CREATE TABLE IF NOT EXISTS apikeys (
+    account_id TEXT, id TEXT, name TEXT, description TEXT, iam_id TEXT, type TEXT,
+    created_by TEXT, created_at TEXT, locked INTEGER, data TEXT, PRIMARY KEY (account_id, id));
+CREATE INDEX IF NOT EXISTS apikeys_iam_id ON apikeys (iam_id);
+CREATE INDEX IF NOT EXISTS apikeys_created_by ON apikeys (created_by);
+CREATE TABLE IF NOT EXISTS serviceids (
+    account_id TEXT, id TEXT, iam_id TEXT, name TEXT, description TEXT,
+    created_at TEXT, locked INTEGER, data TEXT, PRIMARY KEY (account_id, id));
+CREATE INDEX IF NOT EXISTS serviceids_iam_id ON serviceids (iam_id);
+CREATE TABLE IF NOT EXISTS users (
+    account_id TEXT, iam_id TEXT, user_id TEXT, email TEXT, firstname TEXT, lastname TEXT,
+    state TEXT, data TEXT, PRIMARY KEY (account_id, iam_id));
+CREATE TABLE IF NOT EXISTS policies (
+    account_id TEXT, id TEXT, type TEXT, subject_key TEXT, subject_value TEXT, role_id TEXT,
+    resource_key TEXT, resource_value TEXT, created_by_id TEXT, created_at TEXT,
+    last_permit_at TEXT, last_permit_frequency INTEGER, state TEXT, description TEXT, data TEXT,
+    PRIMARY KEY (account_id, id));
+CREATE INDEX IF NOT EXISTS policies_subject ON policies (subject_value);
+CREATE INDEX IF NOT EXISTS policies_created_by ON policies (created_by_id);
+CREATE INDEX IF NOT EXISTS policies_last_permit_at ON policies (last_permit_at);
+CREATE TABLE IF NOT EXISTS activity (
+    account_id TEXT, section TEXT, id TEXT, name TEXT, last_authn TEXT, report_id TEXT, data TEXT,
+    PRIMARY KEY (account_id, section, id));
+CREATE INDEX IF NOT EXISTS activity_id ON activity (id);
+CREATE INDEX IF NOT EXISTS activity_last_authn ON activity (last_authn);
+CREATE TABLE IF NOT EXISTS synced (
+    account_id TEXT, dataset TEXT, synced_at TEXT, rows INTEGER, PRIMARY KEY (account_id, dataset));
+'''
+
+# read an API key from a JSON file
+def readApiKey(filename):
+    with open(filename) as data_file:
+        credentials = json.load(data_file)
+    api_key = credentials.get('apikey')
+    return api_key
+
+# open the inventory database and create the tables if needed
+def openInventory():
+    db=openDatabase('inventory.sqlite')
+    db.executescript(TABLES)
+    return db
+
+# a timestamp as ISO 8601 in UTC, comparable as text and usable with julianday()
+def isoTimestamp(value):
+    timestamp=parseTimestamp(value)
+    return timestamp.strftime('%Y-%m-%dT%H:%M:%SZ') if timestamp is not None else None
+
+# the rows for the API keys of users and service IDs in the account
+def apiKeyRows(iam_token, account_id):
+    for id_type in ['user','serviceid']:
+        for apikeys, next_token in iterApiKeyPages(iam_token, account_id, None, id_type):
+            for apikey in apikeys:
+                yield (account_id, apikey['id'], apikey.get('name'), apikey.get('description'), apikey.get('iam_id'), id_type,
+                       apikey.get('created_by'), isoTimestamp(apikey.get('created_at')), apikey.get('locked'), json.dumps(apikey))
+
+def serviceIDRows(iam_token, account_id):
+    for serviceid in iterServiceIDs(iam_token, account_id):
+        yield (account_id, serviceid['id'], serviceid.get('iam_id'), serviceid.get('name'), serviceid.get('description'),
+               isoTimestamp(serviceid.get('created_at')), serviceid.get('locked'), json.dumps(serviceid))
+
+def userRows(iam_token, account_id):
+    for user in iterUsers(iam_token, account_id):
+        yield (account_id, user['iam_id'], user.get('user_id'), user.get('email'), user.get('firstname'), user.get('lastname'),
+               user.get('state'), json.dumps(user))
+
+# the rows for the V2 policies, with the first subject and resource attribute and role
+def policyRows(iam_token, account_id):
+    for policy in iterPoliciesV2(iam_token, account_id):
+        subject=policy.get('subject',{}).get('attributes',[{}])[0]
+        resource=policy.get('resource',{}).get('attributes',[{}])[0]
+        roles=policy.get('control',{}).get('grant',{}).get('roles',[{}])
+        yield (account_id, policy['id'], policy.get('type'), subject.get('key'), subject.get('value'), roles[0].get('role_id'),
+               resource.get('key'), resource.get('value'), policy.get('created_by_id'), isoTimestamp(policy.get('created_at')),
+               isoTimestamp(policy.get('last_permit_at')), policy.get('last_permit_frequency'), policy.get('state'),
+               policy.get('description'), json.dumps(policy))
+
+# the rows for the entries of an inactive identities report, streamed. None
+# if the report isn't available yet, the stored activity is kept then.
+def activityRows(iam_token, account_id, report_id):
+    report=getReport(iam_token, account_id, report_id, stream=True)
+    if report is None:
+        print("The report {} is not available yet, activity is not synced.".format(report_id), file=sys.stderr)
+        return None
+    return ((account_id, section, item['iam_id'] if section=='users' else item['id'], item.get('name'),
+             isoTimestamp(item.get('last_authn')), report_id, json.dumps(item))
+            for section, item in reportEntries(report))
+
+# update the stored rows of a dataset for the account in one transaction,
+# only rows which are new or changed are written and those which are gone
+# deleted. Returns the number of written and deleted rows.
+def storeRows(db, account_id, dataset, rows):
+    with db:
+        cursor=db.execute('SELECT * FROM {} WHERE account_id=?'.format(dataset), (account_id,))
+        stored=set(cursor)
+        # the primary key columns
+        keys=[row[1] for row in db.execute('PRAGMA table_info({})'.format(dataset)) if row[5]]
+        positions=[[column[0] for column in cursor.description].index(key) for key in keys]
+        current={tuple(row[position] for position in positions) for row in rows}
+        removed=[key for key in {tuple(row[position] for position in positions) for row in stored} if key not in current]
+        changed=[row for row in rows if tuple(row) not in stored]
+        db.executemany('DELETE FROM {} WHERE {}'.format(dataset, ' AND '.join(key+'=?' for key in keys)), removed)
+        if changed:
+            db.executemany('INSERT OR REPLACE INTO {} VALUES ({})'.format(dataset, ','.join('?'*len(changed[0]))), changed)
+        db.execute('INSERT OR REPLACE INTO synced VALUES (?,?,?,?)',
+                   (account_id, dataset, time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), len(rows)))
+    return len(changed), len(removed)
+
+# retrieve the datasets concurrently and store each one once it is complete,
+# a summary of the rows per dataset is printed to stderr. A dataset which
+# isn't available (None instead of rows) is skipped and keeps its stored rows.
+def syncInventory(iam_token, account_id, datasets=DATASETS, report_id='latest'):
+    sources={'apikeys': lambda: apiKeyRows(iam_token, account_id),
+             'serviceids': lambda: serviceIDRows(iam_token, account_id),
+             'users': lambda: userRows(iam_token, account_id),
+             'policies': lambda: policyRows(iam_token, account_id),
+             'activity': lambda: activityRows(iam_token, account_id, report_id)}
+    def collect(dataset):
+        rows=sources[dataset]()
+        return list(rows) if rows is not None else None
+    db=openInventory()
+    try:
+        with ThreadPoolExecutor(max_workers=len(datasets)) as executor:
+            futures={executor.submit(collect, dataset): dataset for dataset in datasets}
+            for future in as_completed(futures):
+                rows=future.result()
+                if rows is None:
+                    continue
+                changed, removed=storeRows(db, account_id, futures[future], rows)
+                print("{}: {} rows, {} new or changed, {} removed".format(futures[future], len(rows), changed, removed), file=sys.stderr)
+    finally:
+        db.close()
+
+# run an SQL query against the inventory and print the result as CSV or JSON
+def queryInventory(sql, out_format, parameters=()):
+    db=openInventory()
+    try:
+        cursor=db.execute(sql, parameters)
+        columns=[column[0] for column in cursor.description or []]
+        if out_format=='CSV':
+            out=csv.writer(sys.stdout)
+            out.writerow(columns)
+            out.writerows(cursor)
+        else:
+            with JSONWriter(ndjson=out_format=='NDJSON') as writer:
+                for row in cursor:
+                    writer.write(dict(zip(columns, row)))
+    finally:
+        db.close()
+
+# a sample line in the Prometheus text format
+def metricLine(name, labels, value):
+    escape=lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return name+('{'+','.join('{}="{}"'.format(key, escape(value)) for key, value in labels.items())+'}' if labels else '')+' {}'.format(value)
+
+# the bucket of the time since the last authentication of an identity
+def inactivityBucket(reported, days):
+    if not reported:
+        return 'not_reported'
+    if days is None:
+        return 'never'
+    lower=0
+    for upper in INACTIVITY_BUCKETS:
+        if days<upper:
+            return '{}-{}d'.format(lower, upper)
+        lower=upper
+    return '{}d+'.format(lower)
+
+# the metrics of the inventory in the Prometheus text format, computed from the
+# stored data. Policies count as not permitted in N days for each N in stale_days.
+# With the status of the serve loop, its syncs and errors are added.
+def inventoryMetrics(db, stale_days, status=None):
+    lines=[]
+    def metric(name, kind, text, samples):
+        lines.append('# HELP {} {}'.format(name, text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        lines.extend(metricLine(name, labels, value) for labels, value in samples)
+
+    keys=list(db.execute('SELECT account_id, type, count(*), sum(locked) FROM apikeys GROUP BY 1,2'))
+    metric('iam_apikeys', 'gauge', 'API keys by owner type',
+           [({'account_id': account, 'type': key_type}, count) for account, key_type, count, locked in keys])
+    metric('iam_apikeys_locked', 'gauge', 'Locked API keys by owner type',
+           [({'account_id': account, 'type': key_type}, locked or 0) for account, key_type, count, locked in keys])
+    # the time since the last authentication is known for keys in the activity report
+    inactivity={}
+    for account, reported, days in db.execute('''SELECT k.account_id, a.id IS NOT NULL, julianday('now')-julianday(a.last_authn)
+                                               FROM apikeys k LEFT JOIN activity a
+                                               ON a.account_id=k.account_id AND a.section='apikeys' AND a.id=k.id
+                                               WHERE k.account_id IN (SELECT account_id FROM synced WHERE dataset='activity')'''):
+        bucket=(account, inactivityBucket(reported, days))
+        inactivity[bucket]=inactivity.get(bucket, 0)+1
+    metric('iam_apikeys_by_inactivity', 'gauge', 'API keys by time since the last authentication, not_reported if not in the activity report',
+           [({'account_id': account, 'inactive': bucket}, count) for (account, bucket), count in sorted(inactivity.items())])
+    metric('iam_serviceids', 'gauge', 'Service IDs',
+           [({'account_id': account}, count) for account, count in db.execute('SELECT account_id, count(*) FROM serviceids GROUP BY 1')])
+    metric('iam_users', 'gauge', 'Users by state',
+           [({'account_id': account, 'state': state}, count) for account, state, count in db.execute('SELECT account_id, state, count(*) FROM users GROUP BY 1,2')])
+    metric('iam_policies', 'gauge', 'Access policies by type',
+           [({'account_id': account, 'type': policy_type}, count) for account, policy_type, count in db.execute('SELECT account_id, type, count(*) FROM policies GROUP BY 1,2')])
+    metric('iam_policies_not_permitted', 'gauge', 'Access policies which did not permit access in the given number of days',
+           [({'account_id': account, 'days': days}, count) for days in stale_days
+            for account, count in db.execute('''SELECT account_id, count(*) FROM policies
+                                              WHERE last_permit_at IS NULL OR julianday('now')-julianday(last_permit_at)>? GROUP BY 1''', (days,))])
+    synced=list(db.execute("SELECT account_id, dataset, rows, strftime('%s', synced_at) FROM synced"))
+    metric('iam_inventory_rows', 'gauge', 'Rows of the dataset in the inventory',
+           [({'account_id': account, 'dataset': dataset}, rows) for account, dataset, rows, synced_at in synced])
+    metric('iam_inventory_synced_timestamp_seconds', 'gauge', 'Time of the last sync of the dataset',
+           [({'account_id': account, 'dataset': dataset}, synced_at) for account, dataset, rows, synced_at in synced])
+    if status is not None:
+        metric('iam_inventory_syncs_total', 'counter', 'Syncs since the start', [({}, status['syncs'])])
+        metric('iam_inventory_sync_errors_total', 'counter', 'Failed syncs since the start', [({}, status['errors'])])
+        metric('iam_inventory_sync_duration_seconds', 'gauge', 'Duration of the last sync', [({}, round(status['duration'], 3))])
+    return '\n'.join(lines)+'\n'
+
+# HTTP handler serving the metrics prepared by the serve loop on /metrics
+def makeMetricsHandler(status):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split('?')[0]!='/metrics':
+                self.send_error(404)
+                return
+            body=status['metrics']
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+    return MetricsHandler
+
+# keep the inventory up to date and serve its metrics. The datasets are synced
+# every "interval" seconds in the background, the metrics are computed after
+# each sync, so a scrape doesn't touch the database or the APIs. A failed sync
+# is counted and retried at the next interval.
+def serveInventory(iam_token, account_id, datasets, report_id, interval, address, port, stale_days):
+    status={'metrics': b'', 'syncs': 0, 'errors': 0, 'duration': 0.0}
+    def updateMetrics():
+        db=openInventory()
+        try:
+            status['metrics']=inventoryMetrics(db, stale_days, status).encode()
+        finally:
+            db.close()
+
+    def refresh():
+        while True:
+            start=time.time()
+            try:
+                syncInventory(iam_token, account_id, datasets, report_id)
+                status['syncs']+=1
+            except (Exception, SystemExit) as e:
+                status['errors']+=1
+                print("Sync failed: {}".format(e), file=sys.stderr)
+            status['duration']=time.time()-start
+            updateMetrics()
+            time.sleep(max(0, interval-(time.time()-start)))
+
+    # serve what is stored from previous runs until the first sync is done
+    updateMetrics()
+    threading.Thread(target=refresh, daemon=True).start()
+    server=ThreadingHTTPServer((address, port), makeMetricsHandler(status))
+    print("Serving metrics on http://{}:{}/metrics".format(address, server.server_address[1]), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+# use split and base64 to get to the content of the IAM token
+def extractAccount(iam_token):
+    data = iam_token.split('.')
+    padded = data[1] + "="*divmod(len(data[1]),4)[1]
+    jsondata = json.loads(base64.urlsafe_b64decode(padded))
+    return jsondata
+
+if __name__== "__main__":
+    credfile=None
+    iam_token=None
+    account_id=None
+
+    # define the command line arguments
+    parser = argparse.ArgumentParser(description='Keep a local inventory of API keys, service IDs, users, policies and activity of an IBM Cloud account')
+    parser.add_argument('--action', choices=['sync','query','serve'], dest='action', default='sync',
+                        help='retrieve the data of the account into the inventory (sync), run an SQL query against it (query) or keep it up to date and serve metrics (serve)')
+    parser.add_argument('--credentials', type=str, action='store', dest='credfile', help='credential file to use')
+    parser.add_argument('--datasets', choices=DATASETS, dest='datasets', default=DATASETS, nargs='*', help='datasets to sync')
+    parser.add_argument('--reportid', type=str, action='store', dest='reportid', default='latest', help='the inactive identities report to sync as activity')
+    parser.add_argument('--sql', type=str, dest='sql', help='the SQL query to run')
+    parser.add_argument('--output', choices=['CSV','JSON','NDJSON'], dest='out_format', default='CSV',
+                        help='return query results in CSV, JSON or newline-delimited JSON format')
+    parser.add_argument('--interval', type=int, dest='interval', default=3600, help='seconds between syncs (serve)')
+    parser.add_argument('--address', type=str, dest='address', default='127.0.0.1', help='address to serve the metrics on (serve)')
+    parser.add_argument('--port', type=int, dest='port', default=9464, help='port to serve the metrics on (serve)')
+    parser.add_argument('--stale-days', type=int, dest='stale_days', default=[30,90,180], nargs='+', help='report policies not permitted in these numbers of days (serve)')
+    parser.add_argument('--profile', nargs='?', const='', dest='profile', metavar='TRACE_FILE', help='print a profile of the requests per endpoint at the end, optionally write a timeline in Chrome trace format to TRACE_FILE')
+    # parse the parameters
+    args = parser.parse_args()
+    if args.profile is not None:
+        profiler.enable(args.profile or None)
+
+    if args.action=='query':
+        if args.sql is None:
+            parser.error('--action query requires --sql')
+        queryInventory(args.sql, args.out_format)
+        sys.exit()
+    # a token from the environment can't be refreshed and expires after an hour
+    if args.action=='serve' and args.credfile is None:
+        parser.error('--action serve requires --credentials')
+
+    # do we have any parameters like the credential file?
+    # if not, let's try to obtain the token from environment
+    if args.credfile is None:
+        if 'IBMCLOUD_TOKEN' in os.environ:
+            iam_token=os.getenv('IBMCLOUD_TOKEN')
+            token_data=extractAccount(iam_token)
+        else:
+            parser.print_help()
+            exit()
+    # we should have a credentials file to read from
+    else:
+        # read credentials from file
+        apiKey=readApiKey(args.credfile)
+        # the IAM access token, reused from previous runs and refreshed before it expires
+        iam_token=TokenManager(apiKey)
+        token_data=iam_token.claims()
+    account_id=token_data["account"]["bss"]
+
+    if args.action=='serve':
+        serveInventory(iam_token, account_id, args.datasets, args.reportid, args.interval, args.address, args.port, args.stale_days)
+    else:
+        syncInventory(iam_token, account_id, args.datasets, args.reportid)
@@ -6,13 +6,37 @@
 #
 # Written by Henrik Loeser, hloeser@de.ibm.com
 
-# only standard packages are used, no installation necessary
-import requests, json, sys,os, base64
+# only the requests package is used, no other installation necessary
+import json, sys,os, base64
 import argparse 
+from contextlib import nullcontext
+from itertools import chain
 from urllib.parse import urlparse,parse_qs
+from IAMclient import fetchOrdered, getJSON, iterPages, setRequestBudget
+from IAMtoken import TokenManager
+from IAMindex import buildIdentityIndex, iterUsers
+from IAMoutput import APIKEYS, STRING, JSONWriter, Schema, TableWriter
+from IAMcache import DetailsCache, Journal, Snapshot
+from IAMprofile import profiled, profiler
 
 
-json_apikeys=[]
+# optional cache for API key details (DetailsCache), enabled by --cache
+details_cache=None
+# state of the previous run (Snapshot), enabled by --since-last
+snapshot=None
+# progress of this run (Journal) to resume it with --resume
+journal=None
+# the fields to output, selected by --fields, None for the full output
+fields=None
+
+# the fields of an API key for --fields. Those of the listing don't need the
+# details of the key, the activity and history are only part of the details.
+API_KEY_FIELDS=['iam_id','created_by','created_by_email','created_at','name','id','locked','last_authn','authn_count','history']
+ACTIVITY_FIELDS={'last_authn','authn_count'}
+HISTORY_FIELDS={'history'}
+# the history is exported as JSON text
+HISTORY_COLUMN=('history', STRING)
+
 
 # to use pagination, the next page token is required
 def extractNextPageToken(next_url):
@@ -27,179 +51,243 @@ def readApiKey(filename):
     api_key = credentials.get('apikey')
     return api_key
 
-# obtain an access token from an IAM API key
-def getAuthTokens(api_key):
-    url     = "https://iam.cloud.ibm.com/identity/token"
-    headers = { "Content-Type" : "application/x-www-form-urlencoded" }
-    data    = "apikey=" + api_key + "&grant_type=urn:ibm:params:oauth:grant-type:apikey"
-    try:
-        response  = requests.post( url, headers=headers, data=data )
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        raise SystemExit(e)
-    return response.json()
-
 # retrieve details about an API key
 def getIAMDetails(api_key, iam_token):
     url     = "https://iam.cloud.ibm.com/v1/apikeys/details"
-    headers = { "Authorization" : iam_token, "IAM-Apikey" : api_key, "Content-Type" : "application/json" }
-    try:
-        response  = requests.get( url, headers=headers )
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        raise SystemExit(e)
-    return response.json()
-
-# retrieve the list of accounts accessible using the token
-def getAccounts(iam_token):
-    url     = "https://accounts.cloud.ibm.com/v1/accounts"
-    headers = { "Authorization" : iam_token }
-    try:
-        response  = requests.get( url, headers=headers )
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        raise SystemExit(e)
+    headers = { "IAM-Apikey" : api_key, "Content-Type" : "application/json" }
+    return getJSON(url, iam_token, headers=headers)
 
-    return response.json()
+# retrieve the list of accounts accessible using the token, following all pages
+def getAccounts(iam_token):
+    base_url = "https://accounts.cloud.ibm.com"
+    def getPage(next_url):
+        return getJSON(base_url+(next_url if next_url is not None else '/v1/accounts'), iam_token)
+    return {'resources': [account for page in iterPages(getPage, lambda page: page.get('next_url')) for account in page['resources']]}
 
-# retrieve users in the account
+# retrieve all users in the account as one list
 def getUsers(iam_token, account_id):
-    pagesize=1
-    base_url = 'https://user-management.cloud.ibm.com'
-    url=base_url+'/v2/accounts/'+account_id+'/users'
-    headers = { "Authorization" : iam_token }
-    payload = {"limit": pagesize}
-    try:
-        response = requests.get(url, headers=headers, params=payload)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:  # This is the correct syntax
-        raise SystemExit(e)
-    result=response.json()
-    temp=result
-    while 'next_url' in temp:
-        url=base_url+temp['next_url']
-        try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-        except requests.exceptions.RequestException as e:  # This is the correct syntax
-            raise SystemExit(e)
-    
-        temp=response.json()
-        result['resources'].extend(temp['resources'])
-    return result
+    return {'resources': list(iterUsers(iam_token, account_id))}
 
-# retrieve all API keys for the given IAM ID (user or service)
-def getApiKeys(iam_token, account_id, iam_id, id_type):
+# retrieve the API keys for the given IAM ID (user or service) page by page,
+# starting with the page token "start" (None for the first page). Yields tuples
+# of the keys of a page and the token of the following page (None on the last page).
+def iterApiKeyPages(iam_token, account_id, iam_id, id_type, start=None):
     pagesize=100
     url = 'https://iam.cloud.ibm.com/v1/apikeys'
-    headers = { "Authorization" : iam_token }
-    if iam_id is None:
-        payload = {"account_id": account_id, "pagesize":pagesize, "scope":"account", "type": id_type}
-    else:
-        payload = {"account_id": account_id, "iam_id": iam_id, "pagesize":pagesize, "type": id_type}
-    try:
-        response = requests.get(url, headers=headers, params=payload)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        raise SystemExit(e)
-
-    result=response.json()
-    temp=result
-    while 'next' in temp:
-        payload = {"account_id": account_id, "iam_id": iam_id, "pagesize":pagesize, "pagetoken":extractNextPageToken(temp['next'])}
-        try:
-            response=requests.get(url, headers=headers, params=payload)
-            response.raise_for_status()
-        except requests.exceptions.RequestException as e:
-            raise SystemExit(e)
-        temp=response.json()
-        result['apikeys'].extend(temp['apikeys'])
-    return result
-
-# get the details for an API key, including history and activities
-def getApiKeyDetails(iam_token, apikey_id):
+    def getPage(pagetoken):
+        if iam_id is None:
+            payload = {"account_id": account_id, "pagesize":pagesize, "scope":"account", "type": id_type}
+        else:
+            payload = {"account_id": account_id, "iam_id": iam_id, "pagesize":pagesize, "type": id_type}
+        if pagetoken is not None:
+            payload["pagetoken"]=pagetoken
+        return getJSON(url, iam_token, params=payload)
+    nextToken=lambda page: extractNextPageToken(page['next']) if 'next' in page else None
+    for page in iterPages(getPage, nextToken, start):
+        yield page['apikeys'], nextToken(page)
+
+# retrieve all API keys for the given IAM ID (user or service)
+def getApiKeys(iam_token, account_id, iam_id, id_type):
+    return {'apikeys': [apikey for apikeys, next_token in iterApiKeyPages(iam_token, account_id, iam_id, id_type)
+                        for apikey in apikeys]}
+
+# get the details for an API key, including history and activities. The
+# history can be large for old keys, by default it is only requested if its
+# field is selected (or all fields are).
+def getApiKeyDetails(iam_token, apikey_id, history=None):
     url = 'https://iam.cloud.ibm.com/v1/apikeys/{}'.format(apikey_id)
-    headers = { "Authorization" : iam_token }
-    # we want EVERYTHING
-    payload={"include_history":True, "include_activity":True}
-    try:
-        response = requests.get(url, headers=headers, params=payload)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        raise SystemExit(e)
+    if history is None:
+        history=fields is None or bool(HISTORY_FIELDS & set(fields))
+    payload={"include_history":history, "include_activity":True}
+    if details_cache is not None:
+        return details_cache.getDetails('apikey_history' if history else 'apikey', apikey_id, url, iam_token, payload)
+    return getJSON(url, iam_token, params=payload)
 
-    return response.json()
+# are the details of the keys needed for the selected fields or is the listing enough
+def needsDetails():
+    return fields is None or bool((ACTIVITY_FIELDS|HISTORY_FIELDS) & set(fields))
+
+# retrieve the service IDs page by page, the maximum page size is 100. The
+# service IDs are yielded as they arrive, the next page is retrieved in the background.
+def iterServiceIDs(iam_token, account_id):
+    pagesize=100
+    url = 'https://iam.cloud.ibm.com/v1/serviceids'
+    def getPage(pagetoken):
+        payload = {"account_id": account_id, "pagesize": pagesize}
+        if pagetoken is not None:
+            payload["pagetoken"]=pagetoken
+        return getJSON(url, iam_token, params=payload)
+    for page in iterPages(getPage, lambda page: extractNextPageToken(page['next']) if 'next' in page else None):
+        yield from page['serviceids']
 
 # retrieve the list of service IDs
 def getServiceIDs(iam_token, account_id):
-    pagesize=25
-    url = 'https://iam.cloud.ibm.com/v1/serviceids'
-    headers = { "Authorization" : iam_token }
-    payload = {"account_id": account_id, "pagesize": pagesize}
-    try:
-        response = requests.get(url, headers=headers, params=payload)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        raise SystemExit(e)
-
-    result=response.json()
-    temp=result
-    while 'next' in temp:
-        payload = {"account_id": account_id, "pagesize":pagesize, "pagetoken":extractNextPageToken(temp['next'])}
-        try:
-            response=requests.get(url, headers=headers, params=payload)
-            response.raise_for_status()
-        except requests.exceptions.RequestException as e:
-            raise SystemExit(e)
-
-        temp=response.json()
-        result['serviceids'].extend(temp['serviceids'])
-    return result
-
-# loop over all the API keys for the (user / service) ID and retrieve the details
-def getAndPrintAPIKeys(iam_token, account_id, iam_id, id_type, out_format, users):
-    api_key_list=getApiKeys(iam_token, account_id, iam_id, id_type)
-    for apikey in api_key_list['apikeys']:
-        #print(apikey)
-        apikey_details=getApiKeyDetails(iam_token, apikey['id'])
-        # some tricky printing because "activity" and last_authn might not be present
+    return {'serviceids': list(iterServiceIDs(iam_token, account_id))}
+
+# print the CSV header, in delta mode with the kind of change as first column.
+# A resumed run continues the previous output without header.
+def printCSVHeader(columns):
+    if journal is not None and journal.resumed:
+        return
+    print(('change, ' if snapshot is not None else '')+columns)
+
+# print an API key as CSV line or pass it to the writer, a JSONWriter for JSON
+# output or a TableWriter for the export. In delta mode, the kind of change is
+# added as first column or field.
+@profiled('format')
+def printAPIKey(apikey_details, out_format, users, writer, change=None):
+    if isinstance(writer, TableWriter):
+        record=apiKeyRecord(apikey_details, users, change)
+        if record['history'] is not None:
+            record['history']=json.dumps(record['history'])
+        writer.write(record)
+    # with selected fields, the output is built from the record
+    elif fields is not None:
+        record=apiKeyRecord(apikey_details, users, change)
         if out_format=='CSV':
-            # identity the email address
-            filtered_values = [x['email'] for x in users['resources'] if apikey_details['created_by'] in x.values() ]
-            # print line of data
-            print("{},{},{},{},{},{},{},{}".format(apikey_details['iam_id'],apikey_details['created_by'],
-                                            filtered_values[0] if filtered_values else None, apikey_details['created_at'],
-                                            apikey_details['name'],apikey_details['id'],apikey_details['locked'],
-                                            apikey_details.get('activity',{}).get('last_authn',None),
-                                            apikey_details.get('activity',{}).get('authn_count', None)))
+            print(("{},".format(change) if snapshot is not None else '')+",".join(csvField(field, record[field]) for field in fields))
         else:
-            json_apikeys.append(apikey_details)
+            writer.write({field: record[field] for field in (['change'] if change is not None else [])+fields})
+    # some tricky printing because "activity" and last_authn might not be present
+    elif out_format=='CSV':
+        # print line of data, look up the email address of the creator
+        print(("{},".format(change) if snapshot is not None else '')+
+              "{},{},{},{},{},{},{},{},{}".format(apikey_details['iam_id'],apikey_details['created_by'],
+                                        users.email(apikey_details['created_by']) if users is not None else None, apikey_details['created_at'],
+                                        apikey_details['name'],apikey_details['id'],apikey_details['locked'],
+                                        apikey_details.get('activity',{}).get('last_authn',None),
+                                        apikey_details.get('activity',{}).get('authn_count', None)))
+    else:
+        writer.write(apikey_details if change is None else dict(apikey_details, change=change))
+
+# a selected field for CSV output, the history as quoted JSON
+def csvField(field, value):
+    if field in HISTORY_FIELDS and value is not None:
+        return '"'+json.dumps(value).replace('"', '""')+'"'
+    return "{}".format(value)
+
+# an API key as record of the APIKEYS schema for the export
+@profiled('format')
+def apiKeyRecord(apikey_details, users, change=None):
+    activity=apikey_details.get('activity',{})
+    return {"change": change, "iam_id": apikey_details['iam_id'], "created_by": apikey_details['created_by'],
+            "created_by_email": users.email(apikey_details['created_by']) if users is not None else None,
+            "created_at": apikey_details['created_at'], "name": apikey_details['name'], "id": apikey_details['id'],
+            "locked": apikey_details['locked'], "last_authn": activity.get('last_authn'), "authn_count": activity.get('authn_count'),
+            "history": apikey_details.get('history')}
+
+# the list-level fields of an API key which indicate a change since the last run.
+# The listing has no activity, so a key which only authenticated since then
+# isn't reported as changed.
+def keyFingerprint(apikey):
+    return [apikey.get('modified_at'), apikey.get('entity_tag')]
+
+# yield the API keys as tuples (apikey, change). In delta mode, only keys added
+# or changed since the last run are passed on, else all keys without change.
+# Keys already reported before a resumed run are skipped.
+def selectAPIKeys(apikeys):
+    for apikey in apikeys:
+        if journal is not None and journal.isDone(apikey['id']):
+            continue
+        if snapshot is None:
+            yield apikey, None
+        else:
+            change=snapshot.check(apikey['id'], keyFingerprint(apikey))
+            if change is not None:
+                yield apikey, change
+
+# retrieve the details for the (apikey, change) tuples and print them, with
+# workers>1 the details are fetched in parallel, output order stays the same.
+# For JSON output, the details are passed to the writer (JSONWriter). If the
+# selected fields are all part of the listing, no details are retrieved.
+def printAPIKeyDetails(iam_token, apikeys, out_format, users, workers=1, writer=None):
+    if needsDetails():
+        details=fetchOrdered(lambda item: getApiKeyDetails(iam_token, item[0]['id']), apikeys, workers)
+    else:
+        details=((item, item[0]) for item in apikeys)
+    for (apikey, change), apikey_details in details:
+        if snapshot is not None:
+            snapshot.update(apikey['id'], apikey_details)
+        printAPIKey(apikey_details, out_format, users, writer, change)
+        if journal is not None:
+            journal.markDone(apikey['id'])
+
+# loop over all the API keys for the (user / service) ID and retrieve the details.
+# In delta mode, details are only retrieved for keys added or changed since the last run.
+# The keys are processed page by page, with a journal the token of the next page
+# is recorded once all keys of a page are reported.
+def getAndPrintAPIKeys(iam_token, account_id, iam_id, id_type, out_format, users, workers=1, writer=None):
+    listing='{}/{}'.format(iam_id, id_type)
+    start=journal.cursor(listing) if journal is not None else None
+    if start=='done':
+        return
+    for apikeys, next_token in iterApiKeyPages(iam_token, account_id, iam_id, id_type, start):
+        printAPIKeyDetails(iam_token, selectAPIKeys(apikeys), out_format, users, workers, writer)
+        if journal is not None:
+            journal.setCursor(listing, next_token if next_token is not None else 'done')
+
+# in delta mode, print the keys of the last run which don't exist anymore
+# and store the state of this run for the next one
+def printRemovedAPIKeys(out_format, users, writer):
+    if snapshot is None:
+        return
+    for apikey_id, apikey_details in snapshot.removed():
+        printAPIKey(apikey_details, out_format, users, writer, 'removed')
+    snapshot.save()
+
+# the columns of the export, only the selected fields in their order (and
+# the kind of change), the history only if selected
+def exportSchema():
+    if fields is None:
+        return APIKEYS
+    column_types=dict(APIKEYS.columns+[HISTORY_COLUMN])
+    return Schema(APIKEYS.name, [('change', column_types['change'])]+[(field, column_types[field]) for field in fields])
 
 # as account admin, retrieve details on API keys for users and service IDs
 # in the entire account. This requires a broad set of privileges and might fail.
-def getEverything(iam_token,account_id, iam_id, out_format):
-    if out_format=='CSV':
-        print('iam_id, created_by, created_by_email, created_at, name, id, locked, last_authn, authn_count')
+# With an export prefix, the keys are exported as table instead (TableWriter).
+def getEverything(iam_token,account_id, iam_id, out_format, workers=1, export=None):
+    # index all account users to augment CSV output with email address for iam_id,
+    # JSON output is written key by key as soon as the details are available
+    users=None
+    writer=None
+    if export is not None:
+        users=buildIdentityIndex(iam_token, account_id)
+        writer=TableWriter(export, exportSchema())
+    elif out_format=='CSV':
+        printCSVHeader(', '.join(fields) if fields is not None else 'iam_id, created_by, created_by_email, created_at, name, id, locked, last_authn, authn_count')
+        if fields is None or 'created_by_email' in fields:
+            users=buildIdentityIndex(iam_token, account_id)
+    else:
+        if fields is not None and 'created_by_email' in fields:
+            users=buildIdentityIndex(iam_token, account_id)
+        writer=JSONWriter(ndjson=out_format=='NDJSON')
 
-    # retrieve all account users to augment output list with email address for iam_id
-    users=getUsers(iam_token, account_id)
-    getAndPrintAPIKeys(iam_token, account_id, None, 'user',out_format, users)
-    getAndPrintAPIKeys(iam_token, account_id, None, 'serviceid',out_format, users)
-    if out_format=='JSON':
-       print(json.dumps(json_apikeys))
+    with writer if writer is not None else nullcontext():
+        getAndPrintAPIKeys(iam_token, account_id, None, 'user',out_format, users, workers, writer)
+        getAndPrintAPIKeys(iam_token, account_id, None, 'serviceid',out_format, users, workers, writer)
+        printRemovedAPIKeys(out_format, users, writer)
 
 # as regular user, retrieve details on API keys for the current user and the related service IDs
-def getEverythingUser(iam_token,account_id, iam_id, out_format):
-    if out_format=='CSV':
-        print('iam_id, created_by, created_at, name, id, locked, last_authn, authn_count')
-        
-    getAndPrintAPIKeys(iam_token, account_id, iam_id, 'user',out_format, None)
-    serviceids=getServiceIDs(iam_token, account_id)
-    
-    for serviceid in serviceids['serviceids']:
-       getAndPrintAPIKeys(iam_token, account_id, serviceid['iam_id'], 'serviceid', out_format, None)
-    if out_format=='JSON':
-       print(json.dumps(json_apikeys))
+def getEverythingUser(iam_token,account_id, iam_id, out_format, workers=1, export=None):
+    if export is not None:
+        writer=TableWriter(export, exportSchema())
+    elif out_format=='CSV':
+        printCSVHeader(', '.join(fields) if fields is not None else 'iam_id, created_by, created_by_email, created_at, name, id, locked, last_authn, authn_count')
+        writer=None
+    else:
+        writer=JSONWriter(ndjson=out_format=='NDJSON')
+
+    # pipeline of three stages running concurrently: the user and the service
+    # IDs (streamed page by page) feed the listing of their keys, which feeds
+    # the retrieval of the key details. The output order stays the same.
+    owners=chain([(iam_id, 'user')],
+                 ((serviceid['iam_id'], 'serviceid') for serviceid in iterServiceIDs(iam_token, account_id)))
+    key_lists=fetchOrdered(lambda owner: getApiKeys(iam_token, account_id, owner[0], owner[1])['apikeys'], owners, workers)
+    apikeys=selectAPIKeys(apikey for owner, owner_keys in key_lists for apikey in owner_keys)
+    with writer if writer is not None else nullcontext():
+        printAPIKeyDetails(iam_token, apikeys, out_format, None, workers, writer)
+        printRemovedAPIKeys(out_format, None, writer)
 
 
 # use split and base64 to get to the content of the IAM token
@@ -217,12 +305,32 @@ if __name__== "__main__":
 
     # define the command line arguments
     parser = argparse.ArgumentParser(description='Retrieve information about API keys in an IBM Cloud account')
-    parser.add_argument('--output', choices=['CSV','JSON'], dest='out_format', default='CSV',
-                        help='return output in CSV or JSON format')
+    parser.add_argument('--output', choices=['CSV','JSON','NDJSON'], dest='out_format', default='CSV',
+                        help='return output in CSV, JSON or newline-delimited JSON format')
     parser.add_argument('--credentials', type=str, action='store', dest='credfile', help='credential file to use')
     parser.add_argument('--type', choices=['admin','user'], type=str, dest='usertype', default='admin', help='existing privilege scope')
+    parser.add_argument('--workers', type=int, dest='workers', default=1, help='number of API key details to retrieve in parallel')
+    parser.add_argument('--cache', action=argparse.BooleanOptionalAction, dest='cache', default=False, help='reuse API key details cached by previous runs')
+    parser.add_argument('--cache-ttl', type=float, dest='cache_ttl', metavar='SECONDS', help='reuse cached details up to this age, default 3600 or IAM_CACHE_TTL')
+    parser.add_argument('--since-last', action='store_true', dest='since_last', help='only report API keys added, changed or removed since the last run with this option, authentications alone are no change')
+    parser.add_argument('--export', type=str, dest='export', metavar='PREFIX', help='export the API keys as table to PREFIX.parquet (with pyarrow) or PREFIX.csv.gz instead of printing them')
+    parser.add_argument('--resume', action='store_true', dest='resume', help='continue an interrupted run without repeating reported API keys')
+    parser.add_argument('--fields', choices=API_KEY_FIELDS, dest='fields', nargs='+', metavar='FIELD',
+                        help='only output these fields, in this order ({}). Details of the keys are only retrieved if needed'.format(', '.join(API_KEY_FIELDS)))
+    parser.add_argument('--profile', nargs='?', const='', dest='profile', metavar='TRACE_FILE', help='print a profile of the requests per endpoint at the end, optionally write a timeline in Chrome trace format to TRACE_FILE')
     # parse the parameters
     args = parser.parse_args()
+    if args.profile is not None:
+        profiler.enable(args.profile or None)
+    if args.resume and args.since_last:
+        parser.error('--resume cannot be combined with --since-last')
+    if args.resume and args.export:
+        parser.error('--resume cannot be combined with --export')
+    if args.resume and args.out_format=='JSON':
+        parser.error('--resume requires CSV or NDJSON output')
+    # the users index for the email addresses is only available to admins
+    if args.usertype=='user' and args.fields is not None and 'created_by_email' in args.fields:
+        parser.error('--fields created_by_email requires --type admin')
 
     # do we have any parameters like the credential file?
     # if not, let's try to obtain the token from environment
@@ -239,10 +347,8 @@ if __name__== "__main__":
     else:
         # read credentials from file 
         apiKey=readApiKey(args.credfile)
-        # create the IAM access token
-        authTokens=getAuthTokens(api_key=apiKey)
-        # and make it a bearer token
-        iam_token='Bearer '+authTokens["access_token"]   
+        # the IAM access token, reused from previous runs and refreshed before it expires
+        iam_token=TokenManager(apiKey)
 
 
         # get account details
@@ -250,7 +356,26 @@ if __name__== "__main__":
         account_id=accDetails['account_id']
         iam_id=accDetails['iam_id']
   
+    fields=args.fields
+    # all stages and workers share one budget of requests in flight
+    if args.workers>1:
+        setRequestBudget(args.workers)
+    if args.cache:
+        details_cache=DetailsCache(args.cache_ttl)
+    if args.since_last:
+        snapshot=Snapshot('IAMkeys/{}/{}'.format(args.usertype, account_id))
+    # JSON output and the export can't be continued, they are not journaled
+    elif args.out_format!='JSON' and args.export is None:
+        journal=Journal('IAMkeys/{}/{}'.format(args.usertype, account_id), args.resume)
+
     if args.usertype=='admin':
-        getEverything(iam_token, account_id, iam_id, args.out_format)
+        getEverything(iam_token, account_id, iam_id, args.out_format, args.workers, args.export)
     else:
-        getEverythingUser(iam_token, account_id, iam_id, args.out_format)
\ No newline at end of file
+        getEverythingUser(iam_token, account_id, iam_id, args.out_format, args.workers, args.export)
+
+    if details_cache is not None:
+        details_cache.close()
+    if snapshot is not None:
+        snapshot.close()
+    if journal is not None:
+        journal.finish()
\ No newline at end of file
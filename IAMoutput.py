@@ -0,0 +1,184 @@
+# Output helpers shared by the IAM scripts. Records are written as soon as
+# they are available instead of being collected in memory first.
+# For loading into a warehouse, records can be exported as typed table, one
+# schema per dataset, as Parquet file if pyarrow is installed and as gzip
+# compressed CSV (properly quoted by the csv module) otherwise.
+
+import csv, gzip, json, sys, threading
+from datetime import datetime, timezone
+from IAMprofile import profiled
+
+# pyarrow is optional, without it tables are exported as CSV
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow=None
+
+
+# records collected before they are written as one batch (row group)
+BATCH_SIZE=10000
+
+# column types of the exported tables
+STRING='string'
+TIMESTAMP='timestamp'
+INTEGER='integer'
+BOOLEAN='boolean'
+
+
+# write records as JSON array, one element at a time, or as newline-delimited
+# JSON (NDJSON) with one record per line. Each record is flushed right away.
+# With a key, the array is wrapped into an object, e.g. {"policies": [...]}.
+# Used as context manager, the array is closed even if the run is interrupted,
+# so partial output is still valid JSON.
+class JSONWriter:
+    def __init__(self, out=None, ndjson=False, key=None):
+        self.out=out if out is not None else sys.stdout
+        self.ndjson=ndjson
+        self.key=key
+        self.count=0
+
+    def __enter__(self):
+        if not self.ndjson:
+            self.out.write('[' if self.key is None else '{'+json.dumps(self.key)+': [')
+        return self
+
+    @profiled('format')
+    def write(self, record):
+        if self.ndjson:
+            self.out.write(json.dumps(record)+'\n')
+        else:
+            self.out.write((',\n' if self.count else '\n')+json.dumps(record))
+        self.count+=1
+        self.out.flush()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.ndjson:
+            self.out.write('\n]\n' if self.key is None else '\n]}\n')
+        self.out.flush()
+        return False
+
+# the columns of an exported dataset as list of (name, type)
+class Schema:
+    def __init__(self, name, columns):
+        self.name=name
+        self.columns=columns
+
+    def names(self):
+        return [name for name, column_type in self.columns]
+
+    # the schema with the account ID as first column, for data of several accounts
+    def withAccount(self):
+        return Schema(self.name, [('account_id', STRING)]+self.columns)
+
+# API keys with details (IAMkeys.py)
+APIKEYS=Schema('apikeys', [
+    ('change', STRING), ('iam_id', STRING), ('created_by', STRING), ('created_by_email', STRING),
+    ('created_at', TIMESTAMP), ('name', STRING), ('id', STRING), ('locked', BOOLEAN),
+    ('last_authn', TIMESTAMP), ('authn_count', INTEGER)])
+
+# access policies (IAMpolicies.py)
+POLICIES=Schema('policies', [
+    ('id', STRING), ('created_by_id', STRING), ('created_by_email', STRING), ('created_at', TIMESTAMP),
+    ('last_permit_at', TIMESTAMP), ('last_permit_frequency', INTEGER), ('state', STRING),
+    ('subject_key1', STRING), ('subject_val1', STRING), ('subject_email', STRING), ('num_subjects', INTEGER),
+    ('resource_key1', STRING), ('resource_val1', STRING), ('num_resources', INTEGER),
+    ('role_id1', STRING), ('description', STRING)])
+
+# entries of the inactive identities report (IAMia.py), the owner is the
+# service ID or user of an API key
+INACTIVE_IDENTITIES=Schema('inactive_identities', [
+    ('change', STRING), ('section', STRING), ('iam_id', STRING), ('name', STRING), ('last_authn', TIMESTAMP),
+    ('type', STRING), ('owner_id', STRING), ('owner_name', STRING), ('username', STRING), ('email', STRING),
+    ('created_by', STRING), ('created_by_email', STRING), ('created_at', TIMESTAMP), ('locked', BOOLEAN),
+    ('authn_count', INTEGER)])
+
+# parse a timestamp as returned by IAM, e.g. 2023-01-01T00:00+0000 or
+# 2023-01-01T00:00:00.000Z, into a datetime in UTC. None if missing or invalid.
+def parseTimestamp(value):
+    if not value:
+        return None
+    value=value.replace('Z', '+00:00')
+    # +0000 to +00:00 for older Python versions
+    if len(value)>5 and value[-5] in '+-' and value[-4:].isdigit():
+        value=value[:-2]+':'+value[-2:]
+    try:
+        timestamp=datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if timestamp.tzinfo is None:
+        return timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.astimezone(timezone.utc)
+
+# convert a value to the type of its column, None for missing values
+def convertValue(value, column_type):
+    if value is None or value=='':
+        return None
+    if column_type==TIMESTAMP:
+        return parseTimestamp(value)
+    if column_type==INTEGER:
+        return int(value)
+    if column_type==BOOLEAN:
+        return value if isinstance(value, bool) else str(value).lower()=='true'
+    return str(value)
+
+# the Arrow type of a column
+def arrowType(column_type):
+    return {STRING: pyarrow.string(), TIMESTAMP: pyarrow.timestamp('ms', tz='UTC'),
+            INTEGER: pyarrow.int64(), BOOLEAN: pyarrow.bool_()}[column_type]
+
+# write records (dicts with the columns of the schema) as table. The file is
+# the given prefix with .parquet if pyarrow is available, else with .csv.gz.
+# Records are converted to the column types and written in batches. Used as
+# context manager, the file is completed even if the run is interrupted.
+# Threads can share a writer, e.g. for a dataset merged from several accounts.
+class TableWriter:
+    def __init__(self, prefix, schema, batch_size=BATCH_SIZE):
+        self.schema=schema
+        self.batch_size=batch_size
+        self.lock=threading.Lock()
+        self.batch=[]
+        self.count=0
+        self.path=prefix+('.parquet' if pyarrow is not None else '.csv.gz')
+
+    def __enter__(self):
+        if pyarrow is not None:
+            self.arrow_schema=pyarrow.schema([(name, arrowType(column_type)) for name, column_type in self.schema.columns])
+            self.parquet=pyarrow.parquet.ParquetWriter(self.path, self.arrow_schema, compression='zstd')
+        else:
+            self.file=gzip.open(self.path, 'wt', newline='', encoding='utf-8')
+            self.csv=csv.writer(self.file)
+            self.csv.writerow(self.schema.names())
+        return self
+
+    @profiled('format')
+    def write(self, record):
+        row=tuple(convertValue(record.get(name), column_type) for name, column_type in self.schema.columns)
+        with self.lock:
+            self.batch.append(row)
+            self.count+=1
+            if len(self.batch)>=self.batch_size:
+                self.flush()
+
+    # write the collected records, as columns for Parquet or as rows for CSV
+    # with timestamps in ISO 8601 format
+    @profiled('format')
+    def flush(self):
+        if not self.batch:
+            return
+        if pyarrow is not None:
+            columns=[pyarrow.array(column, type=self.arrow_schema.field(index).type) for index, column in enumerate(zip(*self.batch))]
+            self.parquet.write_table(pyarrow.Table.from_arrays(columns, schema=self.arrow_schema))
+        else:
+            self.csv.writerows(tuple(value.isoformat() if isinstance(value, datetime) else value for value in row) for row in self.batch)
+        self.batch=[]
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self.lock:
+            self.flush()
+        if pyarrow is not None:
+            self.parquet.close()
+        else:
+            self.file.close()
+        print("Exported {} {} to {}".format(self.count, self.schema.name, self.path), file=sys.stderr)
+        return False
@@ -2,10 +2,16 @@
 #
 # Written by Henrik Loeser, hloeser@de.ibm.com
 
-# only standard packages are used, no installation necessary
-import requests, json, sys,os, base64
+# only the requests package is used, no other installation necessary
+import json, sys,os, base64
 import argparse 
 from urllib.parse import urlparse,parse_qs
+from IAMclient import chainConcurrently, getJSON, iterPages
+from IAMtoken import TokenManager
+from IAMindex import buildIdentityIndex
+from IAMoutput import POLICIES, JSONWriter, TableWriter
+from IAMrecords import Policy
+from IAMprofile import profiled, profiler
 
 
 # read an API key from a JSON file
@@ -15,18 +21,6 @@ def readApiKey(filename):
     api_key = credentials.get('apikey')
     return api_key
 
-# obtain an access token from an IAM API key
-def getAuthTokens(api_key):
-    url     = "https://iam.cloud.ibm.com/identity/token"
-    headers = { "Content-Type" : "application/x-www-form-urlencoded" }
-    data    = "apikey=" + api_key + "&grant_type=urn:ibm:params:oauth:grant-type:apikey"
-    try:
-        response  = requests.post( url, headers=headers, data=data )
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        raise SystemExit(e)
-    return response.json()
-
 # retrieve all API keys for the given IAM ID (user or service)
 # https://cloud.ibm.com/apidocs/iam-policy-management#list-policies
 # NOTE: This function is not used, but shown for easy fallback to or
@@ -34,33 +28,46 @@ def getAuthTokens(api_key):
 def getPoliciesV1(iam_token, account_id, iam_id, id_type):
     pagesize=100
     url = 'https://iam.cloud.ibm.com/v1/policies'
-    headers = { "Authorization" : iam_token }
     payload = {"account_id": account_id, "pagesize":pagesize, "format":"include_last_permit", "sort": "last_permit_at"}
-    try:
-        response = requests.get(url, headers=headers, params=payload)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        raise SystemExit(e)
-
-    result=response.json()
+    result=getJSON(url, iam_token, params=payload)
     return result
 
 
-# retrieve all API keys for the given IAM ID (user or service)
+# retrieve the IAM policies page by page, optionally only those of the given
+# type (access, authorization). The policies are yielded as they arrive, the
+# next page is retrieved in the background.
 # https://cloud.ibm.com/apidocs/iam-policy-management#list-v2-policies
-def getPoliciesV2(iam_token, account_id, iam_id, id_type):
+def iterPoliciesV2(iam_token, account_id, policy_type=None):
     pagesize=100
     url = 'https://iam.cloud.ibm.com/v2/policies'
-    headers = { "Authorization" : iam_token }
-    payload = {"account_id": account_id, "pagesize":pagesize, "format":"include_last_permit", "sort": "last_permit_at"}
-    try:
-        response = requests.get(url, headers=headers, params=payload)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        raise SystemExit(e)
-
-    result=response.json()
-    return result
+    def getPage(start):
+        payload = {"account_id": account_id, "limit":pagesize, "format":"include_last_permit", "sort": "last_permit_at"}
+        if policy_type is not None:
+            payload["type"]=policy_type
+        if start is not None:
+            payload["start"]=start
+        return getJSON(url, iam_token, params=payload)
+    for page in iterPages(getPage, nextPolicyStart):
+        yield from page['policies']
+
+# the V2 policies as compact records (IAMrecords.Policy), for holding all
+# policies in memory, e.g. to index them
+def iterPolicyRecords(iam_token, account_id, policy_type=None):
+    for policy in iterPoliciesV2(iam_token, account_id, policy_type):
+        yield Policy(policy)
+
+# the start token for the next page of policies, None on the last page
+def nextPolicyStart(page):
+    next_page=page.get('next')
+    if next_page is None:
+        return None
+    if 'start' in next_page:
+        return next_page['start']
+    return parse_qs(urlparse(next_page['href']).query)['start'][0]
+
+# retrieve all IAM policies for the account
+def getPoliciesV2(iam_token, account_id, iam_id, id_type):
+    return {'policies': list(iterPoliciesV2(iam_token, account_id))}
 
 # NOTE: This function is not used, but shown for easy fallback to or
 #       additional activation of the version 1 API
@@ -87,43 +94,97 @@ def getEverythingV1(iam_token,account_id, out_format):
         raise("unsupported format")
 
 
-# retrieve the IAM policies and process them
-def getEverythingV2(iam_token,account_id, out_format, subject_types, iam_types):
-    policy_list=getPoliciesV2(iam_token, account_id, None, None)
-    res_list=[]
-    for policy in policy_list['policies']:
-        # access
-        if policy['type'] in subject_types and policy['type']=='access':
-            for subject in policy['subject']['attributes']:
-                if subject['key']=='iam_id' and 'id' in iam_types:
-                    res_list.append(policy)
-                elif subject['key']=='access_group_id' and 'ag' in iam_types:
-                    res_list.append(policy)
-        # authorization
-        elif policy['type'] in subject_types and policy['type']=='authorization':
-            res_list.append(policy)
-
-    pol_list={'policies': res_list}
-    if out_format=='JSON':
-        print(json.dumps(pol_list))
+# the subject attribute keys selected by the IAM types (--iamtype)
+def subjectKeys(iam_types):
+    keys={'id': 'iam_id', 'ag': 'access_group_id'}
+    return {keys[iam_type] for iam_type in iam_types}
+
+# compile the filter by policy type and IAM type of the subject into a
+# predicate, so each policy is checked in one pass
+def policyPredicate(subject_types, iam_types):
+    subject_keys=subjectKeys(iam_types)
+    access='access' in subject_types
+    authorization='authorization' in subject_types
+    def matches(policy):
+        if policy['type']=='access':
+            return access and any(subject['key'] in subject_keys for subject in policy['subject']['attributes'])
+        return authorization and policy['type']=='authorization'
+    return matches
+
+# filter the stream of policies, each policy is passed on at most once
+def filterPoliciesV2(policies, subject_types, iam_types):
+    matches=policyPredicate(subject_types, iam_types)
+    seen=set()
+    for policy in policies:
+        if policy['id'] not in seen and matches(policy):
+            seen.add(policy['id'])
+            yield policy
+
+# the policy types to request from the server. The type filter is applied by
+# the API. Access policies are not requested if no IAM type is selected.
+def requestedPolicyTypes(subject_types, iam_types):
+    return [policy_type for policy_type in dict.fromkeys(subject_types)
+            if policy_type!='access' or subjectKeys(iam_types)]
+
+# retrieve the IAM policies and process them, with a users index (IdentityIndex)
+# the email addresses of the policy creator and the subject are added to CSV output.
+# Each requested policy type is retrieved as partition of its own, all partitions
+# concurrently. The policies are streamed through filtering and output.
+def getEverythingV2(iam_token,account_id, out_format, subject_types, iam_types, users=None, export=None):
+    partitions=[iterPoliciesV2(iam_token, account_id, policy_type) for policy_type in requestedPolicyTypes(subject_types, iam_types)]
+    policies=filterPoliciesV2(chainConcurrently(partitions), subject_types, iam_types)
+    if export is not None:
+        with TableWriter(export, POLICIES) as writer:
+            for policy in policies:
+                writer.write(policyRecord(policy, users))
+    elif out_format=='JSON':
+        with JSONWriter(key='policies') as writer:
+            for policy in policies:
+                writer.write(policy)
     elif out_format=='CSV':
         # assume CSV output
-        print('id, created_by_id, created_at, last_permit_at, last_permit_frequency, state, subject_key1, subject_val1, num_subjects, resource_key1, resource_val1, num_resources, role_id1, description')
-        for policy in pol_list['policies']:
-            print("{},{},{},{},{},{},{},{},{},{},{},{},'{}','{}'".format(policy['id'], policy.get('created_by_id',None), policy.get('created_at',''),
-                                            policy['last_permit_at'],policy['last_permit_frequency'],policy['state'],
-                                            policy['subject']['attributes'][0]['key'],
-                                            policy['subject']['attributes'][0]['value'],
-                                            len(policy['subject']['attributes']),
-                                            policy['resource']['attributes'][0]['key'],
-                                            policy['resource']['attributes'][0]['value'],
-                                            len(policy['resource']['attributes']),
-                                            policy['control']['grant']['roles'][0]['role_id'],
-                                            policy.get('description','')
-                                            ))
+        print('id, created_by_id, created_at, last_permit_at, last_permit_frequency, state, subject_key1, subject_val1, num_subjects, resource_key1, resource_val1, num_resources, role_id1, description'
+              +(', created_by_email, subject_email' if users is not None else ''))
+        for policy in policies:
+            printPolicyRow(policy, users)
     else:
         raise("unsupported format")
 
+# print a V2 policy as CSV line, with a users index the email addresses of
+# creator and subject are added
+@profiled('format')
+def printPolicyRow(policy, users=None):
+    print("{},{},{},{},{},{},{},{},{},{},{},{},'{}','{}'".format(policy['id'], policy.get('created_by_id',None), policy.get('created_at',''),
+                                    policy['last_permit_at'],policy['last_permit_frequency'],policy['state'],
+                                    policy['subject']['attributes'][0]['key'],
+                                    policy['subject']['attributes'][0]['value'],
+                                    len(policy['subject']['attributes']),
+                                    policy['resource']['attributes'][0]['key'],
+                                    policy['resource']['attributes'][0]['value'],
+                                    len(policy['resource']['attributes']),
+                                    policy['control']['grant']['roles'][0]['role_id'],
+                                    policy.get('description','')
+                                    )
+          +(",{},{}".format(users.email(policy.get('created_by_id')),
+                           users.email(policy['subject']['attributes'][0]['value'])) if users is not None else ''))
+
+# a V2 policy as record of the POLICIES schema for the export, with a users
+# index the email addresses of creator and subject are added
+@profiled('format')
+def policyRecord(policy, users=None):
+    subject=policy['subject']['attributes'][0]
+    resource=policy['resource']['attributes'][0]
+    return {"id": policy['id'], "created_by_id": policy.get('created_by_id'),
+            "created_by_email": users.email(policy.get('created_by_id')) if users is not None else None,
+            "created_at": policy.get('created_at'), "last_permit_at": policy.get('last_permit_at'),
+            "last_permit_frequency": policy.get('last_permit_frequency'), "state": policy.get('state'),
+            "subject_key1": subject['key'], "subject_val1": subject['value'],
+            "subject_email": users.email(subject['value']) if users is not None else None,
+            "num_subjects": len(policy['subject']['attributes']),
+            "resource_key1": resource['key'], "resource_val1": resource['value'],
+            "num_resources": len(policy['resource']['attributes']),
+            "role_id1": policy['control']['grant']['roles'][0]['role_id'], "description": policy.get('description')}
+
 # use split and base64 to get to the content of the IAM token
 def extractAccount(iam_token):
     data = iam_token.split('.')
@@ -145,14 +206,20 @@ if __name__== "__main__":
     parser.add_argument('--credentials', type=str, action='store', dest='credfile', help='credential file to use')
     parser.add_argument('--type', choices=['access','authorization'], type=str, dest='subject_types', default=['access','authorization'], nargs='*', help='filter by subject type')
     parser.add_argument('--iamtype', choices=['ag','id'], type=str, dest='iam_types', default=['ag','id'], nargs='*', help='filter by IAM type')
+    parser.add_argument('--export', type=str, dest='export', metavar='PREFIX', help='export the policies as table to PREFIX.parquet (with pyarrow) or PREFIX.csv.gz instead of printing them')
+    parser.add_argument('--emails', action='store_true', dest='emails', help='add email addresses of policy creator and subject to CSV output, requires the privilege to list users')
+    parser.add_argument('--profile', nargs='?', const='', dest='profile', metavar='TRACE_FILE', help='print a profile of the requests per endpoint at the end, optionally write a timeline in Chrome trace format to TRACE_FILE')
     # parse the parameters
     args = parser.parse_args()
+    if args.profile is not None:
+        profiler.enable(args.profile or None)
 
     # do we have any parameters like the credential file?
     # if not, let's try to obtain the token from environment
     if args.credfile is None:
         if 'IBMCLOUD_TOKEN' in os.environ:
             iam_token=os.getenv('IBMCLOUD_TOKEN')
+            token_data=extractAccount(iam_token)
         else:
             parser.print_help()
             exit()
@@ -160,16 +227,15 @@ if __name__== "__main__":
     else:
         # read credentials from file 
         apiKey=readApiKey(args.credfile)
-        # create the IAM access token
-        authTokens=getAuthTokens(api_key=apiKey)
-        # and make it a bearer token
-        iam_token='Bearer '+authTokens["access_token"]   
+        # the IAM access token, reused from previous runs and refreshed before it expires
+        iam_token=TokenManager(apiKey)
+        token_data=iam_token.claims()
 
     # get account details
-    token_data=extractAccount(iam_token)
     account_id=token_data["account"]["bss"]
     iam_id=token_data['iam_id']
 
     # call into the V2-related processing
-    getEverythingV2(iam_token, account_id, args.out_format, args.subject_types, args.iam_types)
+    users=buildIdentityIndex(iam_token, account_id) if args.emails and (args.out_format=='CSV' or args.export) else None
+    getEverythingV2(iam_token, account_id, args.out_format, args.subject_types, args.iam_types, users, args.export)
   
\ No newline at end of file
@@ -0,0 +1,156 @@
+# Request-level profile of a run of the IAM scripts. For each endpoint, the
+# number of requests, retries, latency percentiles, bytes received and the
+# time spent decoding JSON are recorded, for the output the time spent
+# formatting records. At the end of the run, a summary table is printed to
+# stderr and, if requested, a timeline in the Chrome trace format is written,
+# to be opened in chrome://tracing or https://ui.perfetto.dev.
+# Enabled by --profile [TRACE_FILE] of the scripts or the environment variables
+# IAM_PROFILE=1 and IAM_PROFILE_TRACE=<file>. When not enabled, nothing is recorded.
+
+import json, os, re, sys, threading, time, atexit
+from functools import wraps
+from urllib.parse import urlparse
+
+
+# path segments which identify a resource, replaced by {id} in endpoint names
+ID_SEGMENT=re.compile(r'^(?!v\d+$).*\d')
+
+# statistics of the requests against one endpoint
+class EndpointStats:
+    def __init__(self):
+        self.latencies=[]
+        self.retries=0
+        self.bytes=0
+        self.decode_seconds=0.0
+
+# percentile (nearest rank) of sorted values
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values)-1, max(0, int(round(fraction*len(values)+0.5))-1))]
+
+# the name of the endpoint of a request, the method and the URL without query
+# with resource IDs replaced, e.g. "GET iam.cloud.ibm.com/v1/apikeys/{id}"
+def endpointName(method, url):
+    parts=urlparse(url)
+    path='/'.join('{id}' if ID_SEGMENT.match(segment) else segment for segment in parts.path.split('/'))
+    return method+' '+parts.netloc+path
+
+class Profiler:
+    def __init__(self):
+        self.enabled=False
+        self.trace_file=None
+        self.events=None
+        self.threads={}
+        self.endpoints={}
+        self.phases={}
+        self.lock=threading.Lock()
+        self.origin=time.perf_counter()
+
+    # start recording, with a file name also the events for the timeline.
+    # The summary (and the timeline) are written when the run ends.
+    def enable(self, trace_file=None):
+        if self.enabled:
+            return
+        self.enabled=True
+        self.trace_file=trace_file
+        self.events=[] if trace_file else None
+        self.origin=time.perf_counter()
+        atexit.register(self.finish)
+
+    def endpoint(self, name):
+        if name not in self.endpoints:
+            self.endpoints[name]=EndpointStats()
+        return self.endpoints[name]
+
+    # add an event to the timeline, start and duration in seconds from perf_counter()
+    def addEvent(self, category, name, start, duration, args=None):
+        thread=threading.current_thread()
+        self.threads[thread.ident]=thread.name
+        event={"name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": thread.ident,
+               "ts": round((start-self.origin)*1e6, 1), "dur": round(duration*1e6, 1)}
+        if args:
+            event["args"]=args
+        self.events.append(event)
+
+    # one attempt of a request, retry is True for all but the first attempt
+    def request(self, name, start, duration, status=None, size=0, retry=False):
+        with self.lock:
+            stats=self.endpoint(name)
+            stats.latencies.append(duration)
+            stats.bytes+=size
+            if retry:
+                stats.retries+=1
+            if self.events is not None:
+                self.addEvent('request', name, start, duration, {"status": status, "bytes": size, "retry": retry})
+
+    # bytes of a streamed response, received after the request returned
+    def received(self, name, size):
+        with self.lock:
+            self.endpoint(name).bytes+=size
+
+    # time spent decoding the JSON of a response
+    def decoded(self, name, start, duration):
+        with self.lock:
+            self.endpoint(name).decode_seconds+=duration
+            if self.events is not None:
+                self.addEvent('decode', name, start, duration)
+
+    # time spent in another phase, e.g. formatting a record for the output
+    def phase(self, category, name, start, duration):
+        with self.lock:
+            calls, seconds=self.phases.get((category, name), (0, 0.0))
+            self.phases[(category, name)]=(calls+1, seconds+duration)
+            if self.events is not None:
+                self.addEvent(category, name, start, duration)
+
+    # print the summary table to stderr, one line per endpoint and phase
+    def printSummary(self, out=sys.stderr):
+        names=[name for name in self.endpoints]+[category+' '+name for category, name in self.phases]
+        width=max([len(name) for name in names]+[8])
+        print("Profile, {:.2f}s wall time".format(time.perf_counter()-self.origin), file=out)
+        print("{:<{}} {:>8} {:>7} {:>8} {:>8} {:>8} {:>10} {:>9}".format(
+              'endpoint', width, 'requests', 'retries', 'p50 ms', 'p95 ms', 'p99 ms', 'KB', 'decode s'), file=out)
+        for name, stats in sorted(self.endpoints.items(), key=lambda item: -sum(item[1].latencies)):
+            latencies=sorted(stats.latencies)
+            print("{:<{}} {:>8} {:>7} {:>8.1f} {:>8.1f} {:>8.1f} {:>10.1f} {:>9.3f}".format(
+                  name, width, len(latencies), stats.retries, percentile(latencies, 0.5)*1000, percentile(latencies, 0.95)*1000,
+                  percentile(latencies, 0.99)*1000, stats.bytes/1024, stats.decode_seconds), file=out)
+        if self.phases:
+            print("{:<{}} {:>8} {:>9}".format('phase', width, 'calls', 'seconds'), file=out)
+            for (category, name), (calls, seconds) in sorted(self.phases.items(), key=lambda item: -item[1][1]):
+                print("{:<{}} {:>8} {:>9.3f}".format(category+' '+name, width, calls, seconds), file=out)
+
+    # write the timeline with the names of the threads
+    def writeTrace(self):
+        metadata=[{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": ident, "args": {"name": name}}
+                  for ident, name in self.threads.items()]
+        with open(self.trace_file, 'w') as trace_file:
+            json.dump({"traceEvents": metadata+self.events, "displayTimeUnit": "ms"}, trace_file)
+        print("Wrote {} trace events to {}".format(len(self.events), self.trace_file), file=sys.stderr)
+
+    def finish(self):
+        with self.lock:
+            self.printSummary()
+            if self.events is not None:
+                self.writeTrace()
+
+profiler=Profiler()
+
+# record the time spent in the decorated function as phase, e.g. @profiled('format')
+def profiled(category):
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            start=time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.phase(category, func.__qualname__, start, time.perf_counter()-start)
+        return wrapper
+    return decorate
+
+if os.getenv('IAM_PROFILE', '0') not in ('', '0') or os.getenv('IAM_PROFILE_TRACE'):
+    profiler.enable(os.getenv('IAM_PROFILE_TRACE'))
@@ -0,0 +1,38 @@
+# Compact records for policies held in memory, e.g. the index of all access
+# policies of IAMia.py --policies. A decoded policy is a dict of nested dicts
+# and lists of several KB, the record keeps only the fields used for the
+# index and the output in __slots__. Strings with few distinct values, like
+# the type, attribute keys, role IDs and account IDs, are interned, so they
+# are stored once for all policies. Where policies are streamed, e.g. for the
+# output of IAMpolicies.py, the decoded dicts are used directly.
+
+import sys
+
+
+# resource attributes with few distinct values, their values are interned
+INTERNED_RESOURCE_KEYS={'accountId', 'serviceName', 'serviceType'}
+
+# intern a string, other values are returned as they are
+def intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+# a V2 access policy, "subjects" and "resources" are the attributes as tuples
+# of (key, value), "roles" the role IDs
+class Policy:
+    __slots__=('id','type','state','description','created_at','created_by_id','last_permit_at','last_permit_frequency',
+               'subjects','resources','roles')
+
+    def __init__(self, policy):
+        self.id=policy['id']
+        self.type=intern(policy.get('type'))
+        self.state=intern(policy.get('state'))
+        self.description=policy.get('description')
+        self.created_at=policy.get('created_at')
+        self.created_by_id=policy.get('created_by_id')
+        self.last_permit_at=policy.get('last_permit_at')
+        self.last_permit_frequency=policy.get('last_permit_frequency')
+        self.subjects=tuple((intern(attribute['key']), attribute['value']) for attribute in policy['subject']['attributes'])
+        self.resources=tuple((intern(attribute['key']),
+                              intern(attribute['value']) if attribute['key'] in INTERNED_RESOURCE_KEYS else attribute['value'])
+                             for attribute in policy['resource']['attributes'])
+        self.roles=tuple(intern(role['role_id']) for role in policy['control']['grant']['roles'])
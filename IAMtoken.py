@@ -0,0 +1,126 @@
+# Access tokens for the IAM scripts (IAMkeys.py, IAMia.py, IAMpolicies.py).
+# An access token created from an API key is valid for about an hour. The
+# TokenManager caches it in the cache directory, readable only by the user, so
+# that the next run of any of the scripts reuses it instead of creating a new
+# one. Before the token expires, it is refreshed while the running requests
+# keep using the current one, so long runs don't fail halfway through.
+# Set IAM_TOKEN_CACHE=0 to not store tokens on disk.
+# For other accounts the API key has access to, account-scoped tokens are
+# obtained like the IBM Cloud CLI does when switching the account: with the
+# refresh token of the API key and the target account (bss_account).
+
+import base64, hashlib, json, os, threading, time
+from IAMclient import postJSON
+from IAMcache import cacheDir
+
+
+# refresh the token when it expires in less than this many seconds
+REFRESH_MARGIN=300
+# store tokens in the cache directory, turned off by IAM_TOKEN_CACHE=0
+TOKEN_CACHE=os.getenv('IAM_TOKEN_CACHE', '1')!='0'
+# basic authorization of the IBM Cloud CLI client (bx:bx) for refresh tokens
+CLI_CLIENT="Basic Yng6Yng="
+
+# obtain an access token from an IAM API key
+def getAuthTokens(api_key):
+    url     = "https://iam.cloud.ibm.com/identity/token"
+    headers = { "Content-Type" : "application/x-www-form-urlencoded" }
+    data    = "apikey=" + api_key + "&grant_type=urn:ibm:params:oauth:grant-type:apikey"
+    return postJSON(url, headers=headers, data=data)
+
+# obtain an access token for another account the API key has access to. The
+# refresh token is only issued to a client ID, the one of the IBM Cloud CLI.
+def getAccountTokens(api_key, account_id):
+    url     = "https://iam.cloud.ibm.com/identity/token"
+    headers = { "Content-Type" : "application/x-www-form-urlencoded", "Authorization" : CLI_CLIENT }
+    data    = "apikey=" + api_key + "&grant_type=urn:ibm:params:oauth:grant-type:apikey"
+    tokens  = postJSON(url, headers=headers, data=data)
+    data    = "refresh_token=" + tokens['refresh_token'] + "&grant_type=refresh_token&bss_account=" + account_id
+    return postJSON(url, headers=headers, data=data)
+
+# use split and base64 to get to the content (claims) of an access token
+def extractClaims(access_token):
+    data = access_token.split('.')
+    padded = data[1] + "="*divmod(len(data[1]),4)[1]
+    return json.loads(base64.urlsafe_b64decode(padded))
+
+# the current access token for an API key, with an account ID for that account
+# instead of the one of the API key. Pass the TokenManager instead of the
+# bearer token string as "iam_token", the requests ask it for the token when
+# they are sent (IAMclient.apiRequest).
+class TokenManager:
+    def __init__(self, api_key, account_id=None):
+        self.api_key=api_key
+        self.account_id=account_id
+        # the file name is derived from the API key, the key itself is not stored
+        name=hashlib.sha256(api_key.encode()).hexdigest()[:16]+('-'+account_id if account_id is not None else '')
+        self.path=os.path.join(cacheDir(), 'token-'+name+'.json')
+        self.lock=threading.Lock()
+        self.access_token=None
+        self.expiration=0
+        if not self.load():
+            self.refresh()
+
+    # the bearer token for the Authorization header. Only one request refreshes
+    # an expiring token, the others keep using the current one while it is valid.
+    def __call__(self):
+        remaining=self.expiration-time.time()
+        if remaining<REFRESH_MARGIN and self.lock.acquire(blocking=remaining<=0):
+            try:
+                # another request might have refreshed it meanwhile
+                if self.expiration-time.time()<REFRESH_MARGIN:
+                    self.refresh()
+            finally:
+                self.lock.release()
+        return 'Bearer '+self.access_token
+
+    # the claims of the current access token, e.g. account and iam_id
+    def claims(self):
+        return extractClaims(self.access_token)
+
+    # read the token cached by a previous run, return True if it is still
+    # valid long enough
+    def load(self):
+        if not TOKEN_CACHE:
+            return False
+        try:
+            with open(self.path) as token_file:
+                cached=json.load(token_file)
+        except (OSError, ValueError):
+            return False
+        if cached.get('expiration', 0)-time.time()<REFRESH_MARGIN:
+            return False
+        self.access_token=cached['access_token']
+        self.expiration=cached['expiration']
+        return True
+
+    # create a new access token, unless another run already stored a fresh one
+    def refresh(self):
+        if self.load():
+            return
+        if self.account_id is None:
+            tokens=getAuthTokens(self.api_key)
+        else:
+            tokens=getAccountTokens(self.api_key, self.account_id)
+        self.access_token=tokens['access_token']
+        # the exp claim is authoritative, expiration in the response a fallback
+        self.expiration=extractClaims(self.access_token).get('exp', tokens.get('expiration', 0))
+        self.save()
+
+    # expire the current token, e.g. after IAM rejected it (401)
+    def invalidate(self):
+        with self.lock:
+            self.expiration=0
+            if TOKEN_CACHE and os.path.exists(self.path):
+                os.remove(self.path)
+
+    # write the token to a file readable only by the user, replace the
+    # previous file in one step so concurrent runs never read a partial file
+    def save(self):
+        if not TOKEN_CACHE:
+            return
+        os.makedirs(cacheDir(), mode=0o700, exist_ok=True)
+        temp_path=self.path+'.{}.tmp'.format(os.getpid())
+        with os.fdopen(os.open(temp_path, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o600), 'w') as token_file:
+            json.dump({"access_token": self.access_token, "expiration": self.expiration}, token_file)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,94 @@
+# Benchmark the scripts against the local mock server (mockiam.py). Each
+# scenario runs a script as separate process for every account size and
+# reports the wall time, the number of requests, the peak memory (RSS) and
+# the rows of output per second.
+#
+#   python3 benchmarks/bench.py --sizes 100 1000 --latency 0.005
+#   python3 benchmarks/bench.py --scenario IAMkeys --script-args="--workers 8"
+
+import argparse, json, os, shlex, subprocess, sys, tempfile, time
+from mockiam import MockIAM, mockToken, startServer
+
+
+REPO_DIR=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name, script and its parameters, the function exercised
+SCENARIOS={
+    'IAMkeys':      ('IAMkeys.py', [], 'getEverything'),
+    'IAMkeys-user': ('IAMkeys.py', ['--type', 'user'], 'getEverythingUser'),
+    'IAMpolicies':  ('IAMpolicies.py', [], 'getEverythingV2'),
+    'IAMia':        ('IAMia.py', ['--level', 'advanced'], 'getAndPrintInactiveIdentitiesReport'),
+    'IAMia-run':    ('IAMia.py', ['--action', 'run', '--level', 'advanced'], 'waitAndPrintInactiveIdentitiesReport'),
+}
+
+# run a script, write its peak RSS (VmHWM in kB) to BENCH_PEAK_FILE at exit.
+# The peak is taken from /proc as the rusage of a child process also counts
+# the memory of this process (including the mock server) at the time of the fork.
+WRAPPER="""import atexit, os, runpy, sys
+def peak():
+    with open('/proc/self/status') as status, open(os.environ['BENCH_PEAK_FILE'], 'w') as out:
+        out.write(next(line.split()[1] for line in status if line.startswith('VmHWM')))
+atexit.register(peak)
+sys.argv=sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name='__main__')
+"""
+
+# run a script against the mock server, return wall time, rows of output,
+# peak RSS in MB and the exit code
+def runScript(script, script_args, endpoint):
+    with tempfile.NamedTemporaryFile(mode='r') as peak_file:
+        env=dict(os.environ, IAM_API_ENDPOINT=endpoint, IBMCLOUD_TOKEN=mockToken(), BENCH_PEAK_FILE=peak_file.name)
+        # the mock server has no rate limit, measure the scripts rather than the pacing
+        env.setdefault('IAM_RATE_LIMIT', '0')
+        start=time.perf_counter()
+        process=subprocess.Popen([sys.executable, '-c', WRAPPER, os.path.join(REPO_DIR, script)]+script_args,
+                                 cwd=REPO_DIR, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        rows=0
+        for line in process.stdout:
+            rows+=1
+        process.wait()
+        wall=time.perf_counter()-start
+        peak=peak_file.read()
+    return wall, rows, int(peak)/1024 if peak else 0.0, process.returncode
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the IAM scripts against a local mock server')
+    parser.add_argument('--scenario', choices=list(SCENARIOS), nargs='*', dest='scenarios', default=list(SCENARIOS), help='scenarios to run')
+    parser.add_argument('--sizes', type=int, nargs='*', default=[100, 1000, 10000, 50000], help='account sizes (identities)')
+    parser.add_argument('--page-limit', type=int, default=100, dest='page_limit', help='largest page size of the mock server')
+    parser.add_argument('--latency', type=float, default=0.0, help='delay in seconds for each response')
+    parser.add_argument('--rate-429', type=float, default=0.0, dest='rate_429', help='share of responses with status 429')
+    parser.add_argument('--retry-after', type=float, default=1, dest='retry_after', help='seconds in Retry-After of 429 responses')
+    parser.add_argument('--report-delay', type=float, default=0.0, dest='report_delay', help='seconds until a triggered report is available')
+    parser.add_argument('--script-args', type=str, default='', dest='script_args', help='additional parameters for the scripts, e.g. "--workers 8"')
+    parser.add_argument('--output', choices=['table','JSON'], dest='out_format', default='table', help='print results as table or JSON')
+    args = parser.parse_args()
+
+    mock=MockIAM(page_limit=args.page_limit, latency=args.latency, rate_429=args.rate_429, retry_after=args.retry_after, report_delay=args.report_delay)
+    server, endpoint=startServer(mock)
+    results=[]
+    if args.out_format=='table':
+        print('{:<14} {:<38} {:>7} {:>9} {:>9} {:>9} {:>8} {:>10} {:>5}'.format(
+              'scenario', 'function', 'size', 'wall_s', 'requests', 'MB_recv', 'peak_MB', 'rows/s', 'exit'))
+    for scenario in args.scenarios:
+        script, script_args, function=SCENARIOS[scenario]
+        # IAMpolicies has no --workers and similar options
+        extra=shlex.split(args.script_args) if scenario!='IAMpolicies' else []
+        for size in args.sizes:
+            mock.configure(identities=size)
+            wall, rows, peak_rss, exit_code=runScript(script, script_args+extra, endpoint)
+            stats=mock.stats()
+            result={"scenario": scenario, "function": function, "size": size, "wall_s": round(wall, 3),
+                    "requests": stats["requests"], "by_endpoint": stats["by_endpoint"], "throttled": stats["throttled"], "bytes": stats["bytes"],
+                    "peak_rss_mb": round(peak_rss, 1), "rows": rows, "rows_per_s": round(rows/wall, 1), "exit": exit_code}
+            results.append(result)
+            if args.out_format=='table':
+                print('{:<14} {:<38} {:>7} {:>9.2f} {:>9} {:>9.1f} {:>8.1f} {:>10.1f} {:>5}'.format(
+                      scenario, function, size, wall, stats["requests"], stats["bytes"]/2**20, peak_rss, rows/wall, exit_code))
+                sys.stdout.flush()
+    server.shutdown()
+    if args.out_format=='JSON':
+        print(json.dumps(results, indent=2))
+
+if __name__== "__main__":
+    main()
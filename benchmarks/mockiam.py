@@ -0,0 +1,329 @@
+# Local stand-in for the IBM Cloud IAM, user management and policy APIs used
+# by the scripts. The data of an account is generated from its size on the fly,
+# so large accounts don't need much memory. Latency and a rate of 429 responses
+# can be configured to emulate a busy service.
+#
+# Run it standalone, then point the scripts to it:
+#   python3 benchmarks/mockiam.py --identities 1000 --port 8080
+#   export IAM_API_ENDPOINT=http://127.0.0.1:8080
+#   export IBMCLOUD_TOKEN=$(python3 benchmarks/mockiam.py --print-token)
+
+import argparse, base64, json, random, threading, time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+ACCOUNT_ID='mockaccount'
+
+# a token the scripts accept, they only decode the payload
+def mockToken(account_id=ACCOUNT_ID, iam_id='IBMid-user0'):
+    def encode(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip('=')
+    payload={"account": {"bss": account_id}, "iam_id": iam_id, "exp": int(time.time())+3600}
+    return 'Bearer '+encode({"alg": "none"})+'.'+encode(payload)+'.signature'
+
+def timestamp(i):
+    return '2023-{:02d}-{:02d}T{:02d}:00+0000'.format(1+i%12, 1+i%28, i%24)
+
+# the generated content of an account with the given number of identities
+class Account:
+    def __init__(self, identities):
+        self.users=max(1, identities//5)
+        self.serviceids=max(1, identities//5)
+        self.profiles=max(1, identities//20)
+        self.user_keys=identities//2
+        self.service_keys=identities-identities//2
+        self.policies=identities
+
+    def user(self, i):
+        return {"id": "user-{}".format(i), "iam_id": "IBMid-user{}".format(i), "user_id": "user{}@example.com".format(i),
+                "firstname": "First{}".format(i), "lastname": "Last{}".format(i), "state": "ACTIVE",
+                "email": "user{}@example.com".format(i), "account_id": ACCOUNT_ID}
+
+    def serviceid(self, i):
+        return {"id": "ServiceId-{}".format(i), "iam_id": "iam-ServiceId-{}".format(i), "name": "service-{}".format(i),
+                "account_id": ACCOUNT_ID, "created_at": timestamp(i), "entity_tag": "1-{}".format(i)}
+
+    # API keys "u<n>" belong to users, "s<n>" to service IDs
+    def apikey(self, key_id):
+        i=int(key_id[1:])
+        if key_id[0]=='u':
+            iam_id="IBMid-user{}".format(i%self.users)
+        else:
+            iam_id="iam-ServiceId-{}".format(i%self.serviceids)
+        return {"id": "ApiKey-"+key_id, "name": "key-"+key_id, "description": "generated key", "iam_id": iam_id,
+                "account_id": ACCOUNT_ID, "created_at": timestamp(i), "created_by": "IBMid-user{}".format(i%self.users),
+                "modified_at": timestamp(i), "entity_tag": "1-"+key_id, "locked": i%7==0}
+
+    def apikeyDetails(self, key_id):
+        details=self.apikey(key_id)
+        i=int(key_id[1:])
+        details["history"]=[{"timestamp": timestamp(i), "iam_id": details["created_by"], "action": "create",
+                             "params": [], "message": "Created API key"}]
+        if i%3:
+            details["activity"]={"last_authn": timestamp(i+1), "authn_count": i%50}
+        return details
+
+    def keyIds(self, key_type, iam_id):
+        if key_type=='serviceid':
+            prefix, total, owners='s', self.service_keys, self.serviceids
+        else:
+            prefix, total, owners='u', self.user_keys, self.users
+        if iam_id is None:
+            return prefix, range(total)
+        return prefix, range(int(iam_id.rsplit('-',1)[1].replace('user','')), total, owners)
+
+    def profile(self, i):
+        return {"id": "Profile-{}".format(i), "iam_id": "iam-Profile-{}".format(i), "name": "profile-{}".format(i),
+                "created_at": timestamp(i), "entity_tag": "1-{}".format(i),
+                "activity": {"last_authn": timestamp(i), "authn_count": i%20}}
+
+    def policy(self, i):
+        if i%4==0:
+            subject=[{"key": "serviceName", "operator": "stringEquals", "value": "cloud-object-storage"}]
+            policy_type='authorization'
+        elif i%2:
+            subject=[{"key": "iam_id", "operator": "stringEquals", "value": "IBMid-user{}".format(i%self.users)}]
+            policy_type='access'
+        else:
+            subject=[{"key": "access_group_id", "operator": "stringEquals", "value": "AccessGroupId-{}".format(i%50)}]
+            policy_type='access'
+        return {"id": "policy-{}".format(i), "type": policy_type, "description": "generated policy",
+                "subject": {"attributes": subject},
+                "resource": {"attributes": [{"key": "accountId", "operator": "stringEquals", "value": ACCOUNT_ID},
+                                            {"key": "serviceName", "operator": "stringEquals", "value": "service{}".format(i%30)}]},
+                "control": {"grant": {"roles": [{"role_id": "crn:v1:bluemix:public:iam::::role:Viewer"}]}},
+                "state": "active", "created_at": timestamp(i), "created_by_id": "IBMid-user{}".format(i%self.users),
+                "last_permit_at": timestamp(i), "last_permit_frequency": i%100}
+
+    def policyIds(self, policy_type):
+        if policy_type=='authorization':
+            return range(0, self.policies, 4)
+        if policy_type=='access':
+            return [i for i in range(self.policies) if i%4]
+        return range(self.policies)
+
+    def report(self):
+        apikeys=[]
+        for i in range(self.service_keys):
+            key=self.apikey('s{}'.format(i))
+            apikeys.append({"id": key["id"], "name": key["name"], "type": "serviceid", "last_authn": timestamp(i),
+                            "serviceid": {"id": "ServiceId-{}".format(i%self.serviceids), "name": "service-{}".format(i%self.serviceids)}})
+        for i in range(self.user_keys):
+            key=self.apikey('u{}'.format(i))
+            user=self.user(i%self.users)
+            apikeys.append({"id": key["id"], "name": key["name"], "type": "user", "last_authn": timestamp(i),
+                            "user": {"iam_id": user["iam_id"], "name": user["firstname"], "username": user["user_id"], "email": user["email"]}})
+        profiles=[{"id": "Profile-{}".format(i), "name": "profile-{}".format(i), "last_authn": timestamp(i)} for i in range(self.profiles)]
+        users=[{"iam_id": user["iam_id"], "name": user["firstname"], "username": user["user_id"], "email": user["email"],
+                "last_authn": timestamp(i)} for i, user in ((i, self.user(i)) for i in range(self.users))]
+        return {"account_id": ACCOUNT_ID, "report_duration": "720", "apikeys": apikeys, "profiles": profiles, "users": users}
+
+# configuration and statistics of the mock server
+class MockIAM:
+    def __init__(self, identities=100, page_limit=100, latency=0.0, rate_429=0.0, retry_after=1, report_delay=0.0, accounts=1):
+        self.lock=threading.Lock()
+        # seconds sent in Retry-After of 429 responses
+        self.retry_after=retry_after
+        # seconds after a trigger until the report is available (204 before)
+        self.report_delay=report_delay
+        self.report_ready_at=0
+        # number of accounts listed, all with the same content
+        self.accounts=accounts
+        self.configure(identities, page_limit, latency, rate_429)
+
+    def configure(self, identities=None, page_limit=None, latency=None, rate_429=None):
+        with self.lock:
+            if identities is not None:
+                self.account=Account(identities)
+                self.cached_report=None
+            if page_limit is not None:
+                self.page_limit=page_limit
+            if latency is not None:
+                self.latency=latency
+            if rate_429 is not None:
+                self.rate_429=rate_429
+            self.requests=Counter()
+            self.throttled=0
+            self.bytes_sent=0
+
+    def trigger(self):
+        with self.lock:
+            self.report_ready_at=time.time()+self.report_delay
+
+    # the report as JSON, None while it is generated
+    def report(self):
+        with self.lock:
+            if time.time()<self.report_ready_at:
+                return None
+            if self.cached_report is None:
+                self.cached_report=json.dumps(self.account.report()).encode()
+            return self.cached_report
+
+    def count(self, endpoint, status, size):
+        with self.lock:
+            self.requests[endpoint]+=1
+            self.throttled+=status==429
+            self.bytes_sent+=size
+
+    def stats(self):
+        with self.lock:
+            return {"requests": sum(self.requests.values()), "by_endpoint": dict(self.requests),
+                    "throttled": self.throttled, "bytes": self.bytes_sent}
+
+# one page of the items in ids, the cursor is the offset
+def page(ids, start, limit):
+    start=int(start or 0)
+    selected=ids[start:start+limit]
+    return selected, (start+limit if start+limit<len(ids) else None)
+
+def makeHandler(mock):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version='HTTP/1.1'
+        # headers and body are written separately, don't wait for delayed ACKs
+        disable_nagle_algorithm=True
+
+        def log_message(self, format, *args):
+            pass
+
+        def send(self, endpoint, status, body=None, headers=None):
+            data=body if isinstance(body, bytes) else json.dumps(body).encode() if body is not None else b''
+            mock.count(endpoint, status, len(data))
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def handle_request(self, method):
+            parts=urlparse(self.path)
+            query={key: values[0] for key, values in parse_qs(parts.query).items()}
+            path=parts.path.rstrip('/').split('/')
+            if self.headers.get('Content-Length'):
+                data=self.rfile.read(int(self.headers['Content-Length']))
+                # form parameters, e.g. of token requests, are handled like the query
+                if self.headers.get('Content-Type')=='application/x-www-form-urlencoded':
+                    query.update({key: values[0] for key, values in parse_qs(data.decode()).items()})
+            if mock.latency:
+                time.sleep(mock.latency)
+            endpoint, status, body, headers=self.route(method, path, query)
+            if status==200 and mock.rate_429 and random.random()<mock.rate_429:
+                endpoint, status, body, headers=endpoint, 429, {"errors": [{"code": "rate_limit"}]}, {"Retry-After": str(mock.retry_after)}
+            self.send(endpoint, status, body, headers)
+
+        def do_GET(self):
+            self.handle_request('GET')
+
+        def do_POST(self):
+            self.handle_request('POST')
+
+        def route(self, method, path, query):
+            account=mock.account
+            limit=min(int(query.get('pagesize', query.get('limit', 100))), mock.page_limit)
+            base='http://'+self.headers.get('Host', 'localhost')
+            if path==['', 'identity', 'token']:
+                # with bss_account, the token is scoped to that account
+                token=mockToken(query.get('bss_account', ACCOUNT_ID))[len('Bearer '):]
+                return 'token', 200, {"access_token": token, "refresh_token": "mockrefresh", "expires_in": 3600}, None
+            if path==['', 'v1', 'accounts']:
+                # all accounts have the same generated content
+                account_ids=[ACCOUNT_ID]+['{}-{}'.format(ACCOUNT_ID, i) for i in range(1, mock.accounts)]
+                return 'accounts', 200, {"total_results": len(account_ids), "next_url": None,
+                                         "resources": [{"metadata": {"guid": account_id}, "entity": {"name": account_id, "state": "ACTIVE"}}
+                                                       for account_id in account_ids]}, None
+            if path==['', 'v1', 'apikeys', 'details']:
+                return 'apikey_self', 200, {"account_id": ACCOUNT_ID, "iam_id": "IBMid-user0"}, None
+            if path==['', 'v1', 'apikeys']:
+                # like with IAM, the page token keeps the query of the first page
+                key_type, iam_id, offset=query.get('type', 'user'), query.get('iam_id'), None
+                if 'pagetoken' in query:
+                    key_type, iam_id, offset=json.loads(base64.urlsafe_b64decode(query['pagetoken']))
+                prefix, ids=account.keyIds(key_type, iam_id)
+                selected, start=page(ids, offset, limit)
+                body={"apikeys": [account.apikey(prefix+str(i)) for i in selected]}
+                if start is not None:
+                    token=base64.urlsafe_b64encode(json.dumps([key_type, iam_id, start]).encode()).decode()
+                    body["next"]=base+'/v1/apikeys?pagetoken={}'.format(token)
+                return 'apikeys', 200, body, None
+            if len(path)==4 and path[1:3]==['v1', 'apikeys']:
+                key_id=path[3][len('ApiKey-'):]
+                details=account.apikeyDetails(key_id)
+                if query.get('include_history') not in ('True', 'true'):
+                    del details['history']
+                if query.get('include_activity') not in ('True', 'true'):
+                    details.pop('activity', None)
+                return 'apikey_details', 200, details, {"ETag": details["entity_tag"]}
+            if path==['', 'v1', 'serviceids']:
+                selected, start=page(range(account.serviceids), query.get('pagetoken'), limit)
+                body={"serviceids": [account.serviceid(i) for i in selected]}
+                if start is not None:
+                    body["next"]=base+'/v1/serviceids?pagetoken={}'.format(start)
+                return 'serviceids', 200, body, None
+            if len(path)==5 and path[1:3]==['v2', 'accounts'] and path[4]=='users':
+                selected, start=page(range(account.users), query.get('_start'), limit)
+                body={"resources": [account.user(i) for i in selected], "total_results": account.users}
+                if start is not None:
+                    body["next_url"]='/v2/accounts/{}/users?_start={}&limit={}'.format(path[3], start, limit)
+                return 'users', 200, body, None
+            if path==['', 'v2', 'policies']:
+                ids=account.policyIds(query.get('type'))
+                selected, start=page(ids, query.get('start'), limit)
+                body={"policies": [account.policy(i) for i in selected], "limit": limit}
+                if start is not None:
+                    body["next"]={"href": base+'/v2/policies?start={}'.format(start), "start": str(start)}
+                return 'policies', 200, body, None
+            if len(path)==5 and path[1:3]==['v2', 'groups'] and path[4]=='members':
+                # the users i with i%50==k are members of the access group k
+                group=int(path[3].rsplit('-',1)[1])
+                selected, start=page(range(group, account.users, 50), query.get('offset'), limit)
+                body={"members": [{"iam_id": "IBMid-user{}".format(i), "type": "user", "name": "First{}".format(i)} for i in selected],
+                      "limit": limit, "offset": int(query.get('offset', 0)), "total_count": len(range(group, account.users, 50))}
+                if start is not None:
+                    body["next"]={"href": base+'/v2/groups/{}/members?offset={}&limit={}'.format(path[3], start, limit)}
+                return 'group_members', 200, body, None
+            if len(path)==4 and path[1:3]==['v1', 'profiles']:
+                profile=account.profile(int(path[3].rsplit('-',1)[1]))
+                return 'profile_details', 200, profile, {"ETag": profile["entity_tag"]}
+            if len(path)>=6 and path[1:3]==['v1', 'activity'] and path[5]=='report':
+                if method=='POST':
+                    mock.trigger()
+                    return 'report_trigger', 202, {"account_id": ACCOUNT_ID, "reference": "mockreport"}, None
+                report=mock.report()
+                return 'report', 200 if report is not None else 204, report, None
+            return 'unknown', 404, {"errors": [{"code": "not_found", "message": self.path}]}, None
+    return Handler
+
+# start the mock server in a background thread, return server and its URL
+def startServer(mock, port=0):
+    server=ThreadingHTTPServer(('127.0.0.1', port), makeHandler(mock))
+    server.daemon_threads=True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_port)
+
+if __name__== "__main__":
+    parser = argparse.ArgumentParser(description='Local mock of the IBM Cloud IAM APIs for benchmarks')
+    parser.add_argument('--identities', type=int, default=1000, help='size of the generated account')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on')
+    parser.add_argument('--page-limit', type=int, default=100, dest='page_limit', help='largest page size returned')
+    parser.add_argument('--latency', type=float, default=0.0, help='delay in seconds for each response')
+    parser.add_argument('--rate-429', type=float, default=0.0, dest='rate_429', help='share of responses with status 429')
+    parser.add_argument('--retry-after', type=float, default=1, dest='retry_after', help='seconds in Retry-After of 429 responses')
+    parser.add_argument('--report-delay', type=float, default=0.0, dest='report_delay', help='seconds until a triggered report is available')
+    parser.add_argument('--accounts', type=int, default=1, help='number of accounts listed, all with the same content')
+    parser.add_argument('--print-token', action='store_true', dest='print_token', help='print a token for IBMCLOUD_TOKEN and exit')
+    args = parser.parse_args()
+
+    if args.print_token:
+        print(mockToken())
+    else:
+        mock=MockIAM(args.identities, args.page_limit, args.latency, args.rate_429, args.retry_after, args.report_delay, args.accounts)
+        server, url=startServer(mock, args.port)
+        print('Mock IAM listening on {}'.format(url))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            print(json.dumps(mock.stats(), indent=2))